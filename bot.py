@@ -22,7 +22,7 @@ logging.getLogger().addFilter(_RedactTG())
 
 
 import os
-from telegram.ext import ApplicationBuilder, PicklePersistence  # ⬅️ добавили PicklePersistence
+from telegram.ext import ApplicationBuilder, ContextTypes
 
 # Этап 1 — выбор тарифа (/start)
 from handlers.tariff import register_tariff_handlers
@@ -44,16 +44,83 @@ from handlers.menu_banks import register_menu_banks_handlers
 #from handlers.tariff2_text_voice import register_tariff2_handlers
 # Ловим всё остальное
 from handlers.fallback import register_fallback_handler
+# Пул потоков для запросов к Google Sheets
+from services import sheets_gateway, openai_client
+from services.sheets_gateway import row_lock, sheets_background_call
+from services.sheets_service import sort_sheets
+from services.ledger_cache import ledger_cache
+from services.plans_cache import plans_cache
+from services.write_queue import write_queue
+from services.persistence import SQLitePersistence
+from utils.state import UserState
+from services.update_processor import PerUserUpdateProcessor
+
+# Как часто делать профилактическую полную сортировку листов, секунд (0 — никогда).
+# Новые строки и так вставляются на своё место; нужна для ручных правок в таблице.
+# Требует JobQueue: pip install "python-telegram-bot[job-queue]"
+SHEETS_RESORT_INTERVAL = float(os.getenv("SHEETS_RESORT_INTERVAL", "0"))
+
+# Файл SQLite с состоянием пользователей; старый файл PicklePersistence переносится в него один раз
+BOT_STATE_DB     = os.getenv("BOT_STATE_DB", "data/bot_state.sqlite3")
+BOT_STATE_PICKLE = "data/bot_state.pkl"
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook.
+# Webhook требует: pip install "python-telegram-bot[webhooks]"
+BOT_MODE        = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL     = os.getenv("WEBHOOK_URL")            # публичный https-адрес, например https://bot.example.com/tg
+WEBHOOK_LISTEN  = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT    = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH    = os.getenv("WEBHOOK_PATH", "tg")     # путь локального HTTP-сервера
+WEBHOOK_SECRET  = os.getenv("WEBHOOK_SECRET")         # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+# Сколько апдейтов обрабатывать одновременно (апдейты одного пользователя — всё равно по очереди)
+CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "32" if BOT_MODE == "webhook" else "1"))
+
+
+async def on_shutdown(app):
+    """Корректно останавливаем фоновые ресурсы при выключении бота."""
+    # сначала дописываем в таблицы всё, что ещё стоит в очереди записи
+    await write_queue.flush_all()
+    sheets_gateway.shutdown()
+    await openai_client.close()
+
+
+async def resort_sheets_job(context):
+    """Полная сортировка листов всех подключённых таблиц."""
+    urls = {ud.get("sheet_url") for ud in context.application.user_data.values()}
+    # user_data подгружается лениво — остальных пользователей берём из базы
+    persistence = context.application.persistence
+    if isinstance(persistence, SQLitePersistence):
+        urls.update(ud.get("sheet_url") for _, ud in persistence.iter_user_data())
+    urls.discard(None)
+    for url in urls:
+        try:
+            # сортировка переставляет строки — под замком номеров строк
+            async with row_lock(url):
+                await sheets_background_call(url, sort_sheets, url)
+                ledger_cache.resort(url)
+                plans_cache.invalidate(url)
+        except Exception as e:
+            logging.warning("Профилактическая сортировка %s не удалась: %s", url, e)
 
 def main():
     token = os.getenv("TELEGRAM_TOKEN")
     os.makedirs("data", exist_ok=True)  # ✅ гарантируем папку для файла состояния
 
-    # ✅ Включаем постоянное хранение состояния (user_data/chat_data/conversations)
-    persistence = PicklePersistence(filepath="data/bot_state.pkl")
+    # ✅ Включаем постоянное хранение состояния (user_data/chat_data/conversations):
+    #    по строке на пользователя в SQLite, подгрузка — при первом апдейте пользователя
+    persistence = SQLitePersistence(filepath=BOT_STATE_DB, migrate_from=BOT_STATE_PICKLE)
 
     # ✅ Передаём persistence в Application
-    app = ApplicationBuilder().token(token).persistence(persistence).build()
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .persistence(persistence)
+        # user_data: постоянные ключи + черновики с TTL (см. utils/state.py)
+        .context_types(ContextTypes(user_data=UserState))
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Регистрируем этапы в порядке выполнения
     register_tariff_handlers(app)       # /start
@@ -67,7 +134,28 @@ def main():
     register_operations_handlers(app)   # /add  
     register_fallback_handler(app)      # всё остальное
 
-    app.run_polling()
+    if SHEETS_RESORT_INTERVAL > 0:
+        if app.job_queue is None:
+            logging.warning("SHEETS_RESORT_INTERVAL задан, но JobQueue не установлен — сортировка отключена")
+        else:
+            app.job_queue.run_repeating(
+                resort_sheets_job,
+                interval=SHEETS_RESORT_INTERVAL,
+                first=SHEETS_RESORT_INTERVAL,
+            )
+
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL or not WEBHOOK_SECRET:
+            raise SystemExit("BOT_MODE=webhook: задайте WEBHOOK_URL и WEBHOOK_SECRET")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
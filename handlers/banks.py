@@ -20,7 +20,8 @@ from utils.constants import (
     STATE_BANK_EDIT_CHOICE,
     STATE_BANK_EDIT_INPUT,
 )
-from services.sheets_service import open_finance_and_plans
+from services.write_queue import write_queue
+from services.ledger_cache import ledger_cache, with_row_id
 
 
 # —————— 3.1 Главное меню банков ——————
@@ -46,9 +47,8 @@ async def show_banks_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
 
     # 4) Читаем уже добавленные в таблицу банки
-    finance_ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
-    existing = finance_ws.col_values(3)[1:]
-    unique = sorted(set(existing))
+    ledger = await ledger_cache.get(context.user_data["sheet_url"])
+    unique = sorted(b for b in ledger.value_counts(2) if b)
 
     # 5) Готовим список новых (отложенных) банков с суммами
     pending = context.user_data["pending_banks"]
@@ -101,9 +101,9 @@ async def handle_bank_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     # Пропустить добавление
     if data == "skip_add":
-        ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
+        ledger = await ledger_cache.get(context.user_data["sheet_url"])
         # Если уже есть записи в таблице или отложенные банки — завершаем
-        if len(ws.col_values(3)) > 1 or context.user_data.get("pending_banks"):
+        if any(ledger.value_counts(2)) or context.user_data.get("pending_banks"):
             await query.edit_message_text(
                 "▶️ Продолжаем без заполнения банков.\n\n"
                 "Теперь вы можете вводить операции командой /add"
@@ -117,10 +117,12 @@ async def handle_bank_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     # Финиш: записать все отложенные банки
     if data == "finish_setup":
-        ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
+        url = context.user_data["sheet_url"]
         pending = context.user_data.get("pending_banks", [])
-        for entry in pending:
-            ws.append_row(entry["row_data"], value_input_option="USER_ENTERED")
+        # все банки — одним пакетом через очередь записи
+        rows = [with_row_id(entry["row_data"]) for entry in pending]
+        if rows:
+            write_queue.submit(url, rows, bot=context.bot, chat_id=query.message.chat.id)
         lines = [f"• {e['bank']}: {e['amount']:.2f}" for e in pending] or ["– ничего –"]
         summary = "\n".join(lines)
         await query.edit_message_text(
@@ -228,11 +230,13 @@ async def handle_bank_option(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     if data == "finish_setup":
         # 3.1 Получаем ссылку на Google Sheets
-        ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
+        url = context.user_data["sheet_url"]
         # 3.2 Записываем в таблицу все отложенные банки
         pending = context.user_data.get("pending_banks", [])
-        for entry in pending:
-           ws.append_row(entry["row_data"], value_input_option="USER_ENTERED")
+        # все банки — одним пакетом через очередь записи
+        rows = [with_row_id(entry["row_data"]) for entry in pending]
+        if rows:
+            write_queue.submit(url, rows, bot=context.bot, chat_id=query.message.chat.id)
         # 3.3 Формируем текст-отчёт
         lines = [f"• {e['bank']}: {e['amount']:.2f}" for e in pending] or ["– ничего –"]
         summary = "\n".join(lines)
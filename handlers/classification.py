@@ -1,23 +1,14 @@
 # handlers/classification.py
 
-import calendar
-import re
-from datetime import datetime, date
-from typing import Optional, Dict
+from datetime import date
+from typing import Optional, Dict, Tuple
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
 
-from services.sheets_service import open_finance_and_plans
+from services.ledger_cache import ledger_cache
 from utils.constants import STATE_CLASS_MENU
 
-# Карта родительного падежа месяцев на номер
-GENITIVE_MONTHS = {
-    "января":   1, "февраля":  2, "марта":    3, "апреля": 4,
-    "мая":      5, "июня":     6, "июля":     7, "августа":8,
-    "сентября": 9, "октября": 10, "ноября":  11, "декабря":12,
-}
-
 # Названия месяцев для заголовков
 RUS_MONTHS = [
     None, "январь","февраль","март","апрель","май","июнь",
@@ -25,102 +16,47 @@ RUS_MONTHS = [
 ]
 
 
-def parse_sheet_date(s: str) -> Optional[date]:
-    """
-    Пробуем распарсить строку даты из Google Sheets:
-      - DD.MM.YYYY
-      - YYYY-MM-DD
-      - MM/DD/YYYY
-      - «DD месяц, ...» (русский родительный падеж, без года → текущий год)
-    """
-    s = s.strip()
-    # DD.MM.YYYY
-    if re.match(r"^\d{2}\.\d{2}\.\d{4}$", s):
-        d, m, y = map(int, s.split("."))
-        return date(y, m, d)
-
-    # YYYY-MM-DD
-    if re.match(r"^\d{4}-\d{2}-\d{2}$", s):
-        y, m, d = map(int, s.split("-"))
-        return date(y, m, d)
-
-    # MM/DD/YYYY
-    try:
-        return datetime.strptime(s, "%m/%d/%Y").date()
-    except:
-        pass
-
-    # Русский формат «13 июля, вс» или «13 июля»
-    m = re.match(r"^(\d{1,2})\s+([А-Яа-я]+)(?:\,.*)?$", s)
-    if m:
-        day = int(m.group(1))
-        month_name = m.group(2).lower()
-        month = GENITIVE_MONTHS.get(month_name)
-        if month:
-            year = date.today().year
-            return date(year, month, day)
-    # ISO-формат
-    try:
-        return datetime.fromisoformat(s).date()
-    except:
-        return None
+# Сколько последних месяцев предлагать в выборе своего периода
+CUSTOM_MONTHS = 24
 
 
 def aggregate_by_period(
-    rows: list,
-    start: Optional[date],
-    end:   Optional[date]
+    ledger,
+    first: Optional[Tuple[int, int]],
+    last:  Optional[Tuple[int, int]]
 ) -> Dict[str, float]:
     """
     Считает сумму по каждой Классификации (столбец G, индекс 6)
-    в диапазоне [start, end] включительно. Если граница None — без фильтра.
+    за месяцы first..last включительно — (год, месяц); None — без границы.
+    Берётся из помесячного куба Ledger.rollup — строки не перебираются.
     """
     data: Dict[str, float] = {}
-    for r in rows:
-        dt = parse_sheet_date(r[4])
-        if not dt:
-            continue
-        if start and dt < start:
-            continue
-        if end   and dt > end:
-            continue
-
-        cls = r[6].strip() or "—"
-        raw = str(r[5]).replace("\xa0", "").replace(" ", "").replace(",", ".")
-        try:
-            amt = float(raw)
-        except:
-            continue
-
+    for cls, amt in ledger.rollup.range(first, last).items():
+        cls = cls.strip() or "—"
         data[cls] = data.get(cls, 0.0) + amt
     return data
 
 
-async def start_classification(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Показываем пользователю агрегированную статистику за текущий месяц."""
-    q = update.callback_query
-    await q.answer()
-
-    url = context.user_data.get("sheet_url")
-    if not url:
-        return await q.edit_message_text("⚠️ Сначала подключите таблицу: /setup")
-
-    # Читаем все строки листа «Финансы»
-    ws, _ = open_finance_and_plans(url)
-    rows = ws.get_all_values()[1:]
+def _period_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("За предыдущий месяц", callback_data="class_prev"),
+            InlineKeyboardButton("За год"               , callback_data="class_year"),
+        ],
+        [
+            InlineKeyboardButton("За всё время"         , callback_data="class_all"),
+            InlineKeyboardButton("📅 Свой период"       , callback_data="class_custom"),
+        ],
+        [
+            InlineKeyboardButton("🔙 Назад"             , callback_data="class_back"),
+        ],
+    ])
 
-    today = date.today()
-    # Границы текущего месяца
-    first = date(today.year, today.month, 1)
-    last_day = calendar.monthrange(today.year, today.month)[1]
-    last  = date(today.year, today.month, last_day)
 
-    data = aggregate_by_period(rows, first, last)
+def _format_report(header: str, data: Dict[str, float], empty: str = "— нет данных —") -> str:
     items = sorted(data.items(), key=lambda x: x[1])
-
-    header = f"🏷️ *Классификации за {RUS_MONTHS[today.month]} {today.year}:*"
     if not items:
-        body = "— нет данных за этот месяц —"
+        body = empty
     else:
         # форматируем с пробелами и запятой
         body = "\n".join(
@@ -128,21 +64,33 @@ async def start_classification(update: Update, context: ContextTypes.DEFAULT_TYP
             .replace(",", "X").replace(".", ",").replace("X", " ")
             for i, (cls, amt) in enumerate(items)
         )
+    return f"{header}\n{body}"
 
-    text = f"{header}\n{body}"
 
-    kb = [
-        [
-            InlineKeyboardButton("За предыдущий месяц", callback_data="class_prev"),
-            InlineKeyboardButton("За год"               , callback_data="class_year"),
-        ],
-        [
-            InlineKeyboardButton("За всё время"         , callback_data="class_all"),
-            InlineKeyboardButton("🔙 Назад"             , callback_data="class_back"),
-        ],
-    ]
+def _month_name(year: int, month: int) -> str:
+    return f"{RUS_MONTHS[month]} {year}"
+
+
+async def start_classification(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Показываем пользователю агрегированную статистику за текущий месяц."""
+    q = update.callback_query
+    await q.answer()
+
+    url = context.user_data.get("sheet_url")
+    if not url:
+        return await q.edit_message_text("⚠️ Сначала подключите таблицу: /setup")
+
+    # Лист «Финансы» (из кэша)
+    ledger = await ledger_cache.get(url)
+
+    today = date.today()
+    month = (today.year, today.month)
+    data = aggregate_by_period(ledger, month, month)
+
+    text = _format_report(f"🏷️ *Классификации за {_month_name(*month)}:*", data,
+                          empty="— нет данных за этот месяц —")
     await q.edit_message_text(text, parse_mode="Markdown",
-                              reply_markup=InlineKeyboardMarkup(kb))
+                              reply_markup=_period_keyboard())
     return STATE_CLASS_MENU
 
 
@@ -153,22 +101,20 @@ async def handle_class_period(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     period = q.data  # class_prev / class_year / class_all
     url = context.user_data.get("sheet_url")
-    ws, _ = open_finance_and_plans(url)
-    rows = ws.get_all_values()[1:]
+    ledger = await ledger_cache.get(url)
 
     today = date.today()
     if period == "class_prev":
         # предыдущий месяц
         pm = today.month - 1 or 12
         py = today.year if today.month > 1 else today.year - 1
-        first = date(py, pm, 1)
-        last_day = calendar.monthrange(py, pm)[1]
-        last  = date(py, pm, last_day)
-        period_name = f"предыдущий месяц ({RUS_MONTHS[pm]} {py})"
+        first = last = (py, pm)
+        period_name = f"предыдущий месяц ({_month_name(py, pm)})"
 
     elif period == "class_year":
-        first = date(today.year, 1, 1)
-        last  = today
+        # с января по текущий месяц включительно
+        first = (today.year, 1)
+        last  = (today.year, today.month)
         period_name = f"текущий год ({today.year})"
 
     else:  # class_all
@@ -176,33 +122,84 @@ async def handle_class_period(update: Update, context: ContextTypes.DEFAULT_TYPE
         last  = None
         period_name = "всё время"
 
-    data = aggregate_by_period(rows, first, last)
-    items = sorted(data.items(), key=lambda x: x[1])
+    data = aggregate_by_period(ledger, first, last)
+    text = _format_report(f"🏷️ *Классификации за {period_name}:*", data)
+    await q.edit_message_text(text, parse_mode="Markdown",
+                              reply_markup=_period_keyboard())
+    return STATE_CLASS_MENU
 
-    header = f"🏷️ *Классификации за {period_name}:*"
-    if not items:
-        body = "— нет данных —"
-    else:
-        body = "\n".join(
-            f"{i+1}. {cls} — {amt:,.2f}"
-            .replace(",", "X").replace(".", ",").replace("X", " ")
-            for i, (cls, amt) in enumerate(items)
-        )
 
-    text = f"{header}\n{body}"
+def _parse_month(s: str) -> Tuple[int, int]:
+    """'2025-06' → (2025, 6)."""
+    y, m = s.split("-")
+    return int(y), int(m)
 
-    kb = [
-        [
-            InlineKeyboardButton("За предыдущий месяц", callback_data="class_prev"),
-            InlineKeyboardButton("За год"               , callback_data="class_year"),
-        ],
-        [
-            InlineKeyboardButton("За всё время"         , callback_data="class_all"),
-            InlineKeyboardButton("🔙 Назад"             , callback_data="class_back"),
-        ],
+
+def _months_keyboard(months, prefix: str) -> InlineKeyboardMarkup:
+    """Кнопки месяцев по три в ряд; callback_data = prefix + 'ГГГГ-ММ'."""
+    buttons = [
+        InlineKeyboardButton(_month_name(y, m), callback_data=f"{prefix}{y}-{m:02d}")
+        for y, m in months
     ]
+    rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    rows.append([InlineKeyboardButton("🔙 Назад", callback_data="menu:classification")])
+    return InlineKeyboardMarkup(rows)
+
+
+async def handle_class_custom(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Свой период, шаг 1 (class_custom): выбор первого месяца
+    из последних CUSTOM_MONTHS месяцев, в которых есть операции.
+    """
+    q = update.callback_query
+    await q.answer()
+
+    url = context.user_data.get("sheet_url")
+    ledger = await ledger_cache.get(url)
+    months = ledger.rollup.months()[-CUSTOM_MONTHS:]
+    if not months:
+        await q.edit_message_text("— нет данных —", reply_markup=_period_keyboard())
+        return STATE_CLASS_MENU
+
+    await q.edit_message_text("📅 С какого месяца?",
+                              reply_markup=_months_keyboard(months, "class_from:"))
+    return STATE_CLASS_MENU
+
+
+async def handle_class_from(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Свой период, шаг 2 (class_from:ГГГГ-ММ): выбор последнего месяца, не раньше первого."""
+    q = update.callback_query
+    await q.answer()
+
+    start = q.data.split(":", 1)[1]
+    first = _parse_month(start)
+    url = context.user_data.get("sheet_url")
+    ledger = await ledger_cache.get(url)
+    months = [m for m in ledger.rollup.months() if m >= first][:CUSTOM_MONTHS]
+
+    await q.edit_message_text(f"📅 С {_month_name(*first)} по какой месяц?",
+                              reply_markup=_months_keyboard(months, f"class_to:{start}:"))
+    return STATE_CLASS_MENU
+
+
+async def handle_class_range(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Свой период, итог (class_to:ГГГГ-ММ:ГГГГ-ММ): суммы за выбранные месяцы."""
+    q = update.callback_query
+    await q.answer()
+
+    _, start, end = q.data.split(":")
+    first, last = _parse_month(start), _parse_month(end)
+    url = context.user_data.get("sheet_url")
+    ledger = await ledger_cache.get(url)
+
+    data = aggregate_by_period(ledger, first, last)
+    if first == last:
+        period_name = _month_name(*first)
+    else:
+        period_name = f"{_month_name(*first)} — {_month_name(*last)}"
+    text = _format_report(f"🏷️ *Классификации за {period_name}:*", data)
     await q.edit_message_text(text, parse_mode="Markdown",
-                              reply_markup=InlineKeyboardMarkup(kb))
+                              reply_markup=_period_keyboard())
     return STATE_CLASS_MENU
 
 
@@ -5,7 +5,10 @@ from telegram.ext import (
     CallbackQueryHandler, ConversationHandler,
     ContextTypes, MessageHandler, filters
 )
-from services.sheets_service import open_finance_and_plans
+from services.sheets_gateway import open_worksheets, row_lock, sheets_call
+from services.ledger_cache import ledger_cache, ID_COL
+from services.sheets_service import move_row
+from utils.state import DRAFT_TTL, guard_drafts
 from utils.constants import (
     STATE_OP_MENU,
     STATE_OP_LIST, STATE_OP_SELECT,
@@ -13,19 +16,6 @@ from utils.constants import (
     STATE_OP_EDIT_INPUT
 )
 
-# — сортировка по дате «Я → А»
-SORT_REQUEST = {
-    "requests":[{ "sortRange": {
-        "range": {
-            "sheetId":           None,  # заполним динамически
-            "startRowIndex":     1,
-            "startColumnIndex":  0,
-            "endColumnIndex":    8,
-        },
-        "sortSpecs":[{ "dimensionIndex":4, "sortOrder":"DESCENDING" }]
-    }}]
-}
-
 # — точные заголовки «Финансы»
 EXPECTED_HEADERS = ["Год","Месяц","Банк","Операция","Дата","Сумма","Классификация","Конкретика"]
 
@@ -39,6 +29,69 @@ GENITIVE_MONTHS = {
 }
 
 
+async def _write_row(url: str, op: dict, new_row=None):
+    """
+    Находит строку операции op и перезаписывает её (A:H) значениями new_row
+    или удаляет (new_row=None); кэш обновляется тут же. Перед записью сверяем
+    ID в колонке I найденной строки с листом. После правки строка
+    переносится на место по дате (move_row). Поиск номера, запись
+    и обновление кэша — под одним row_lock, поэтому вставка из очереди записи
+    не сдвинет строки между ними. Возвращает номер строки или None — не нашли.
+    """
+    ws, _ = await open_worksheets(url)
+    async with row_lock(url):
+        row_number = await _find_row_number(url, op)
+        if row_number and op.get("ID") and await _id_at(url, ws, row_number) != op["ID"]:
+            # кэш разошёлся с листом (сортировка вручную, /setup) — перечитываем и ищем заново
+            ledger_cache.invalidate(url)
+            row_number = await _find_row_number(url, op)
+            if row_number and await _id_at(url, ws, row_number) != op["ID"]:
+                row_number = None
+        if not row_number:
+            return None
+        if new_row is None:
+            await sheets_call(url, ws.delete_rows, row_number)
+            ledger_cache.delete(url, row_number)
+        else:
+            cell_range = f"A{row_number}:H{row_number}"
+            await sheets_call(url, ws.update, cell_range, [new_row], value_input_option="USER_ENTERED")
+            ledger_cache.update(url, row_number, new_row)
+            # дату могли поменять — переносим строку на её место, лист остаётся отсортированным
+            ledger = ledger_cache.peek(url)
+            target = ledger.sorted_position(row_number) if ledger else row_number
+            if target != row_number:
+                await sheets_call(url, move_row, ws, row_number, target)
+                ledger_cache.move(url, row_number, target)
+    return row_number
+
+
+async def _id_at(url: str, ws, row_number: int) -> str:
+    """ID из колонки I строки row_number — прямо с листа, без кэша."""
+    values = await sheets_call(url, ws.get, f"I{row_number}")
+    return values[0][0] if values and values[0] else ""
+
+
+async def _find_row_number(url: str, op: dict):
+    """
+    Номер строки операции на листе «Финансы»: по её ID из колонки I — сразу из индекса кэша.
+    Если ID не нашёлся (кэш перечитан, а ID не удалось сохранить в таблицу) —
+    ищем, как раньше, по Банк/Дата/Сумма.
+    Вызывать под row_lock(url), вместе с записью по найденному номеру.
+    """
+    ledger = await ledger_cache.get(url, locked=True)
+    row_number = ledger.row_number(op.get("ID"))
+    if row_number:
+        return row_number
+    for i, values in enumerate(ledger.rows, start=2):
+        if (
+            values[2] == op["Банк"] and
+            values[4] == op["Дата"] and
+            values[5] == str(op["Сумма"])
+        ):
+            return i
+    return None
+
+
 # Правельный выход в меню
 async def exit_to_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
@@ -63,15 +116,10 @@ async def start_men_oper(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not url:
         return await query.edit_message_text("⚠️ Сначала подключите таблицу: /setup")
     
-    ws, _ = open_finance_and_plans(url)
-    # 1) Отсортировать лист
-    sheet_id = ws._properties["sheetId"]
-    SORT_REQUEST["requests"][0]["sortRange"]["range"]["sheetId"] = sheet_id
-    ws.spreadsheet.batch_update(SORT_REQUEST)
-    
-    # 2) Забрать все записи
-    all_values = ws.get_all_values()   # возвращает header + строки данных
-    data_rows = all_values[1:1+10]     # первые 10 записей, пропуская заголовок
+    # 1-2) Берём 10 самых свежих записей из кэша листа —
+    #      сортируем у себя, сам лист на чтение не пересортировываем
+    ledger = await ledger_cache.get(url)
+    data_rows = [r for _, r in ledger.latest(10)]
     last_ops = []
     for row_values in data_rows:
         last_ops.append({
@@ -83,6 +131,7 @@ async def start_men_oper(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "Сумма":           row_values[5],
             "Классификация":   row_values[6],
             "Конкретика":      row_values[7] or "",
+            "ID":              row_values[ID_COL],
         })
     context.user_data["last_ops"] = last_ops
 
@@ -117,9 +166,13 @@ async def start_men_oper(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def handle_op_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Пользователь нажал на номер 0–9 — показываем детали + кнопки действий."""
     query = update.callback_query
-    await query.answer()
     idx = int(query.data.split("_")[-1])
-    row = context.user_data["last_ops"][idx]
+    last_ops = context.user_data.get("last_ops")
+    if not last_ops or idx >= len(last_ops):
+        # список выброшен вместе с черновиками (или кнопка от старого списка) — показываем заново
+        return await start_men_oper(update, context)
+    await query.answer()
+    row = last_ops[idx]
         # row — это dict с полями из листа
     context.user_data["editing_op"] = {
         "index":    idx,
@@ -168,27 +221,7 @@ async def handle_op_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text("⚠️ Нет данных для сохранения.")
         return await start_men_oper(update, context)
 
-    # 2) Открываем таблицу
-    ws, _ = open_finance_and_plans(url)
-
-    # 3) Ищем номер строки по оригинальным Банк/Дата/Сумма
-    all_vals = ws.get_all_values()
-    row_number = None
-    for i, values in enumerate(all_vals[1:], start=2):
-        if (
-            values[2] == orig["Банк"] and
-            values[4] == orig["Дата"] and
-            values[5] == str(orig["Сумма"])
-        ):
-            row_number = i
-            break
-
-    if not row_number:
-        await query.edit_message_text("⚠️ Не удалось найти строку для обновления.")
-        return await start_men_oper(update, context)
-
-    # 4) Собираем список новых значений по столбцам A–H
-    # ——— Нормализация даты в DD.MM.YYYY ———
+    # 2) Нормализация даты в DD.MM.YYYY
     raw_date = new.get("Дата")
     # если уже в ISO-формате YYYY-MM-DD
     if re.match(r"^\d{4}-\d{2}-\d{2}$", raw_date):
@@ -208,7 +241,7 @@ async def handle_op_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
             # не удалось распарсить — оставляем как есть
             date_for_sheet = raw_date
             
-    # 5) Собираем список новых значений по столбцам A–H        
+    # 3) Собираем список новых значений по столбцам A–H
     new_row = [
         new.get("Год"),
         new.get("Месяц"),
@@ -220,11 +253,12 @@ async def handle_op_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
         new.get("Конкретика") or "-"
     ]
 
-    # 5) Перезаписываем эту же строку одним вызовом
-    cell_range = f"A{row_number}:H{row_number}"
-    ws.update(cell_range, [new_row], value_input_option="USER_ENTERED")
+    # 4) Перезаписываем строку операции (номер — по её ID) одним вызовом
+    if not await _write_row(url, orig, new_row):
+        await query.edit_message_text("⚠️ Не удалось найти строку для обновления.")
+        return await start_men_oper(update, context)
 
-    # 6) Уведомляем и возвращаемся к списку операций
+    # 5) Уведомляем и возвращаемся к списку операций
     await query.edit_message_text("✅ Операция успешно обновлена.")
     context.user_data.pop("editing_op", None)
     return await start_men_oper(update, context)
@@ -238,42 +272,9 @@ async def handle_op_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await query.edit_message_text("🗑 Операция удалена.")
 
     # удаляем строку в Google Sheets
-    ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
+    url = context.user_data["sheet_url"]
     row = context.user_data["editing_op"]["data"]
-
-    # парсим сумму из выбранной операции
-    try:
-        target_sum = float(
-            str(row["Сумма"])
-            .replace("\xa0","")
-            .replace(" ","")
-            .replace(",",".")
-        )
-    except (KeyError, ValueError):
-        target_sum = None  # на всякий случай
-
-    all_vals = ws.get_all_values()
-    for idx, values in enumerate(all_vals[1:], start=2):
-        bank_cell = values[2]
-        date_cell = values[4]
-        # нормализуем сумму из листа
-        try:
-            sum_cell = float(
-                str(values[5])
-                .replace("\xa0","")
-                .replace(" ","")
-                .replace(",",".")
-            )
-        except ValueError:
-            continue
-
-        if (
-            bank_cell == row["Банк"] and
-            date_cell == row["Дата"] and
-            (target_sum is None or sum_cell == target_sum)
-        ):
-            ws.delete_rows(idx)
-            break
+    await _write_row(url, row)
 
     # сразу перерисовываем обновлённый список последних 10 операций
     return await start_men_oper(update, context)
@@ -373,9 +374,8 @@ async def ask_bank(update: Update, context: ContextTypes.DEFAULT_TYPE, current_v
     # Загружаем список банков пользователя (кэшируем)
     banks = context.user_data.get("user_banks")
     if banks is None:
-        ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
-        rows = ws.get_all_values()[1:]
-        banks = sorted({ row[2] for row in rows if row[2] })
+        ledger = await ledger_cache.get(context.user_data["sheet_url"])
+        banks = sorted(b for b in ledger.value_counts(2) if b)
         context.user_data["user_banks"] = banks
 
     # Строим клавиатуру
@@ -773,27 +773,7 @@ async def handle_save_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await q.edit_message_text("⚠️ Нет данных для сохранения.")
         return await start_men_oper(update, context)
 
-    # 2) Открываем лист
-    ws, _ = open_finance_and_plans(url)
-
-    # 3) Находим строку по оригинальным полям (Банк, Дата, Сумма)
-    all_vals = ws.get_all_values()
-    row_number = None
-    for i, values in enumerate(all_vals[1:], start=2):
-        if (
-            values[2] == orig["Банк"] and
-            values[4] == orig["Дата"] and
-            values[5] == str(orig["Сумма"]) and
-            values[6] == orig.get("Классификация", "")
-        ):
-            row_number = i
-            break
-
-    if not row_number:
-        await q.edit_message_text("⚠️ Не удалось найти строку для обновления.")
-        return await start_men_oper(update, context)
-
-    # 4) Нормализуем дату в ISO (YYYY-MM-DD), даже если её не трогали
+    # 2) Нормализуем дату в ISO (YYYY-MM-DD), даже если её не трогали
     date_val = new.get("Дата")
     # если уже в формате ISO — оставляем
     if not re.match(r"^\d{4}-\d{2}-\d{2}$", date_val):
@@ -810,7 +790,7 @@ async def handle_save_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             # если не удалось распарсить, оставляем исход
             pass
 
-    # 5) Собираем новый список A–H
+    # 3) Собираем новый список A–H
     new_row = [
         new.get("Год"),
         new.get("Месяц"),
@@ -822,15 +802,16 @@ async def handle_save_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         new.get("Конкретика") or "-"
     ]
 
-    # 6) Обновляем эту же строку одним вызовом
-    cell_range = f"A{row_number}:H{row_number}"
-    ws.update(cell_range, [new_row], value_input_option="USER_ENTERED")
+    # 4) Обновляем строку операции (номер — по её ID) одним вызовом
+    if not await _write_row(url, orig, new_row):
+        await q.edit_message_text("⚠️ Не удалось найти строку для обновления.")
+        return await start_men_oper(update, context)
 
-    # 7) Уведомляем и чистим временные данные
+    # 5) Уведомляем и чистим временные данные
     await q.edit_message_text("✅ Операция успешно обновлена.")
     context.user_data.pop("editing_op", None)
 
-    # 8) Возвращаемся к списку последних операций
+    # 6) Возвращаемся к списку последних операций
     return await start_men_oper(update, context)
 
 
@@ -840,9 +821,8 @@ async def handle_op_by_bank(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     banks = context.user_data.get("user_banks")
     if banks is None:
-        ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
-        rows = ws.get_all_values()[1:]
-        banks = sorted({row[2] for row in rows if row[2]})
+        ledger = await ledger_cache.get(context.user_data["sheet_url"])
+        banks = sorted(b for b in ledger.value_counts(2) if b)
         context.user_data["user_banks"] = banks
     kb = [[InlineKeyboardButton(b, callback_data=f"op_bank_choice_{b}")] for b in banks]
     kb.append([InlineKeyboardButton("🔙 Назад", callback_data="op_back_to_list")])
@@ -862,18 +842,14 @@ async def handle_op_bank_choice(update: Update, context: ContextTypes.DEFAULT_TY
     url = context.user_data.get("sheet_url")
     if not url:
         return await query.edit_message_text("⚠️ Сначала подключите таблицу: /setup")
-    ws, _ = open_finance_and_plans(url)
-    sheet_id = ws._properties["sheetId"]
-    SORT_REQUEST["requests"][0]["sortRange"]["range"]["sheetId"] = sheet_id
-    ws.spreadsheet.batch_update(SORT_REQUEST)
-    all_rows = ws.get_all_values()[1:]
-    filtered = [r for r in all_rows if r[2] == bank]
-    data_rows = filtered[:10]
+    ledger = await ledger_cache.get(url)
+    data_rows = [r for _, r in ledger.latest(10, bank=bank)]
     last_ops = [{
         "Год": r[0], "Месяц": r[1], "Банк": r[2],
         "Операция": r[3], "Дата": r[4],
         "Сумма": r[5], "Классификация": r[6],
-        "Конкретика": r[7] or ""
+        "Конкретика": r[7] or "",
+        "ID": r[ID_COL]
     } for r in data_rows]
     context.user_data["last_ops"] = last_ops
     lines = [
@@ -901,7 +877,8 @@ async def handle_op_bank_choice(update: Update, context: ContextTypes.DEFAULT_TY
 def register_men_oper_handlers(app):
     conv = ConversationHandler(
         entry_points=[ CallbackQueryHandler(start_men_oper, pattern=r"^menu:men_oper$") ],
-        states={
+        # карточка и правка читают черновик editing_op: если его выбросили — выходим в меню
+        states=guard_drafts({
             STATE_OP_LIST: [
                 CallbackQueryHandler(start_men_oper, pattern=r"^menu:men_oper$")
             ],
@@ -929,8 +906,13 @@ def register_men_oper_handlers(app):
                 CallbackQueryHandler(handle_date_choice,      pattern=r"^select_date\|[\d\-]+$"),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_edit_input),
             ],
-        },
+        }, "editing_op", skip=(
+            start_men_oper, handle_op_select, handle_op_by_bank,
+            handle_op_bank_choice, exit_to_main_menu,
+        )),
         fallbacks=[ CallbackQueryHandler(exit_to_main_menu, pattern=r"^menu:open$") ],
         allow_reentry=True,
+        # диалог не переживает свой черновик (нужен JobQueue; без него остаётся guard_drafts)
+        conversation_timeout=DRAFT_TTL,
     )
     app.add_handler(conv)
\ No newline at end of file
@@ -4,19 +4,21 @@ import logging
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
 from telegram.ext import CommandHandler, CallbackQueryHandler, ContextTypes
 
-from services.sheets_service import open_finance_and_plans
+from services.sheets_gateway import sheets_call
+from services.sheets_service import invalidate_worksheets
+from services.ledger_cache import ledger_cache
 from utils.constants import STATE_OP_MENU  # ваше состояние после /add
 from handlers.men_oper import start_men_oper  # импорт ветки «Операции»
 
 from handlers.classification import (
-  start_classification, handle_class_period, handle_class_back
+  start_classification, handle_class_period, handle_class_back,
+  handle_class_custom, handle_class_from, handle_class_range
 )
 from utils.constants import STATE_CLASS_MENU
 
 from telegram.ext import MessageHandler
 from telegram.ext import filters
 from handlers.menu_banks import show_banks_menu
-from services.sheets_service import open_finance_and_plans
 
 
 def _build_main_kb() -> InlineKeyboardMarkup:
@@ -75,26 +77,10 @@ async def handle_menu_selection(update: Update, context: ContextTypes.DEFAULT_TY
             return STATE_OP_MENU
 
         try:
-            ws, _ = open_finance_and_plans(url)
-
-            # --- здесь реальная вставка вместо get_all_records ---
-            # тянем из столбца C (3-я) — банки, и из F (6-я) — суммы, пропуская заголовок
-            bank_list = ws.col_values(3)[1:]
-            sum_list  = ws.col_values(6)[1:]
-
-            balances = {}
-            for bank, raw in zip(bank_list, sum_list):
-                if not bank:
-                    # пропускаем пустые строки
-                    continue
-                # приводим «1 234,56» → «1234.56»
-                s = str(raw).replace("\xa0", "").replace(" ", "").replace(",", ".")
-                try:
-                    amt = float(s)
-                except ValueError:
-                    # если вдруг не число — пропускаем
-                    continue
-                balances[bank] = balances.get(bank, 0.0) + amt
+            # остатки по банкам ведутся в кэше листа и меняются на дельту
+            # при каждой записи бота — здесь только читаем готовый результат
+            view = await ledger_cache.balances(url)
+            balances = view.snapshot()
             # ------------------------------------------------------------
 
         except Exception as e:
@@ -177,13 +163,10 @@ async def handle_new_sheet_response(update: Update, context: ContextTypes.DEFAUL
     url = update.message.text.strip()
 
     # Проверяем только чтение таблицы (без модификаций)
-    import os
-    from gspread import service_account as gspread_sa
+    from services.google_client import get_client
 
-    creds = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
     try:
-        sa = gspread_sa(filename=creds)
-        sa.open_by_url(url)
+        await sheets_call(url, lambda: get_client().open_by_url(url))
     except Exception as e:
         await update.message.reply_text(
             f"❌ Не удалось открыть таблицу на чтение: {e}\n"
@@ -191,7 +174,8 @@ async def handle_new_sheet_response(update: Update, context: ContextTypes.DEFAUL
         )
         return
 
-    # Сохраняем новый URL
+    # Сохраняем новый URL; листы этой таблицы откроем заново при первом обращении
+    invalidate_worksheets(url)
     context.user_data["sheet_url"] = url
     # Снимаем флаг ожидания
     context.user_data.pop("awaiting_sheet_url", None)
@@ -221,6 +205,9 @@ def register_menu_handlers(app):
     app.add_handler(CallbackQueryHandler(start_classification,pattern=r"^menu:classification$"))
     app.add_handler(CallbackQueryHandler(handle_class_period,pattern=r"^class_(prev|year|all)$"))
     app.add_handler(CallbackQueryHandler(handle_class_back,pattern=r"^class_back$"))
+    app.add_handler(CallbackQueryHandler(handle_class_custom,pattern=r"^class_custom$"))
+    app.add_handler(CallbackQueryHandler(handle_class_from,pattern=r"^class_from:\d{4}-\d{2}$"))
+    app.add_handler(CallbackQueryHandler(handle_class_range,pattern=r"^class_to:\d{4}-\d{2}:\d{4}-\d{2}$"))
 
     # 3) Раздел «Планы»
     #app.add_handler(CallbackQueryHandler(start_plans,pattern=r"^menu:plans$"))
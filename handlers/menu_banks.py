@@ -20,7 +20,8 @@ from utils.constants import (
     STATE_BANK_EDIT_CHOICE,
     STATE_BANK_EDIT_INPUT,
 )
-from services.sheets_service import open_finance_and_plans
+from services.write_queue import write_queue
+from services.ledger_cache import ledger_cache, with_row_id
 
 
 # —————— 3.1 Главное меню банков ——————
@@ -46,9 +47,8 @@ async def show_banks_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return ConversationHandler.END
 
     # 4) Получаем уже добавленные в Google Sheets банки
-    finance_ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
-    existing = finance_ws.col_values(3)[1:]
-    unique = sorted(set(existing))
+    ledger = await ledger_cache.get(context.user_data["sheet_url"])
+    unique = sorted(b for b in ledger.value_counts(2) if b)
 
     # 5) Готовим список отложенных (новых) банков
     pending = context.user_data["pending_banks"]
@@ -110,10 +110,12 @@ async def handle_bank_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     # Готово → записываем все pending, закрываем текущее окно и открываем главное меню
     if data == "finish_setup":
         # 1) Записываем в Google Sheets
-        ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
+        url = context.user_data["sheet_url"]
         pending = context.user_data.get("pending_banks", [])
-        for entry in pending:
-            ws.append_row(entry["row_data"], value_input_option="USER_ENTERED")
+        # все банки — одним пакетом через очередь записи
+        rows = [with_row_id(entry["row_data"]) for entry in pending]
+        if rows:
+            write_queue.submit(url, rows, bot=context.bot, chat_id=query.message.chat.id)
 
         # 2) Формируем отчёт по всем добавленным банкам
         summary = "\n".join(f"• {e['bank']}: {e['amount']:.2f}" for e in pending) or "– ничего –"
@@ -232,10 +234,12 @@ async def handle_bank_option(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Готово — срабатывает и в STATE_BANK_MENU, и в STATE_BANK_OPTION
     if data == "finish_setup":
         # 1) Пишем все отложенные банки в Google Sheets
-        ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
+        url = context.user_data["sheet_url"]
         pending = context.user_data.get("pending_banks", [])
-        for entry in pending:
-            ws.append_row(entry["row_data"], value_input_option="USER_ENTERED")
+        # все банки — одним пакетом через очередь записи
+        rows = [with_row_id(entry["row_data"]) for entry in pending]
+        if rows:
+            write_queue.submit(url, rows, bot=context.bot, chat_id=query.message.chat.id)
 
         # 2) Формируем отчёт по всем банкам
         summary = "\n".join(f"• {e['bank']}: {e['amount']:.2f}" for e in pending) or "– ничего –"
@@ -28,8 +28,9 @@ from utils.constants import (
     STATE_ENTER_CLASSIFICATION,
     STATE_ENTER_SPECIFIC,
 )
-from utils.state import init_user_state
-from services.sheets_service import open_finance_and_plans
+from utils.state import DRAFT_TTL, guard_drafts, init_user_state
+from services.write_queue import write_queue
+from services.ledger_cache import ledger_cache, with_row_id
 from collections import Counter
 
 # Месяцы по-русски
@@ -215,8 +216,8 @@ async def handle_calendar_callback(update: Update, context: ContextTypes.DEFAULT
 
 # 4.6 — выбор банка
 async def ask_bank(update_or_query, context: ContextTypes.DEFAULT_TYPE) -> int:
-    ws,_=open_finance_and_plans(context.user_data["sheet_url"])
-    banks=sorted(set(ws.col_values(3)[1:]))
+    ledger=await ledger_cache.get(context.user_data["sheet_url"])
+    banks=sorted(ledger.value_counts(2))
     # Формируем список кнопок банков
     buttons = [
         InlineKeyboardButton(b, callback_data=f"select_bank|{b}")
@@ -310,19 +311,30 @@ async def handle_amount_input(update: Update, context: ContextTypes.DEFAULT_TYPE
 # 4.9 — меню топ‑9 популярных классификаций + ввод своей
 async def ask_classification_menu(update_or_query, context: ContextTypes.DEFAULT_TYPE) -> int:
     # 1) Собираем данные
-    ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
-    raw = ws.col_values(7)[1:]  # столбец G без заголовка
+    ledger = await ledger_cache.get(context.user_data["sheet_url"])
+    counts = ledger.value_counts(6)  # столбец G: {классификация: число строк}
 
     # 2) Фильтруем и берём топ‑9 по частоте, исключая «Перевод» и «Старт»
     from collections import Counter
-    popular = [cat for cat, _ in Counter(raw).most_common(20) if cat not in ("Перевод","Старт")]
+    popular = [cat for cat, _ in Counter(counts).most_common(20) if cat not in ("Перевод","Старт")]
+
+    # 3) Если конкретика уже введена — первой ставим классификацию, которую подсказывает её история
+    guess = None
+    spec = context.user_data["pending_op"].get("Конкретика")
+    if spec:
+        guess = ledger.classifier.predict(spec)
+    if guess:
+        popular = [guess[0]] + [c for c in popular if c != guess[0]]
     top9 = popular[:9]
 
-    # 3) Строим кнопки по 3 в ряд
+    # 4) Строим кнопки по 3 в ряд
     rows = []
     for i in range(0, len(top9), 3):
         chunk = top9[i : i + 3]
-        rows.append([InlineKeyboardButton(c, callback_data=f"select_class|{c}") for c in chunk])
+        rows.append([
+            InlineKeyboardButton(f"⭐ {c}" if guess and c == guess[0] else c, callback_data=f"select_class|{c}")
+            for c in chunk
+        ])
 
     text = "🏷️ Выберите или введите вашу классификацию:"
     markup = InlineKeyboardMarkup(rows)
@@ -364,9 +376,15 @@ async def input_classification(update: Update, context: ContextTypes.DEFAULT_TYP
     return await show_fields_menu(update, context)
 
 
-# 4.11 — ввод конкретики
+# 4.11 — ввод конкретики; если классификация ещё не выбрана — подставляем угаданную
 async def input_specific(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["pending_op"]["Конкретика"]=update.message.text.strip()
+    op = context.user_data["pending_op"]
+    op["Конкретика"]=update.message.text.strip()
+    if op.get("Классификация") is None and op.get("Операция") != "Перевод":
+        ledger = await ledger_cache.get(context.user_data["sheet_url"])
+        guess = ledger.classifier.predict(op["Конкретика"])
+        if guess:
+            op["Классификация"] = guess[0]
     return await show_fields_menu(update, context)
 
 # 4.12 — запись и возврат, учёт Перевод
@@ -376,38 +394,19 @@ async def handle_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     dt=datetime.fromisoformat(op["Дата"])
     year, month=dt.year, RU_MONTHS[dt.month]
     date_str=dt.strftime("%d.%m.%Y")
-    ws, _ = open_finance_and_plans(context.user_data["sheet_url"])
+    url = context.user_data["sheet_url"]
 
     if op["Операция"]=="Перевод":
         src=op["Банк Отправитель"]; dst=op["Банк Получатель"]; amt=op["Сумма"]
-        ws.append_row([year,month,src,"Перевод",date_str,-amt,"Перевод",dst], value_input_option="USER_ENTERED")
-        ws.append_row([year,month,dst,"Перевод",date_str,amt,"Перевод",src],  value_input_option="USER_ENTERED")
+        new_rows=[with_row_id([year,month,src,"Перевод",date_str,-amt,"Перевод",dst]),
+                  with_row_id([year,month,dst,"Перевод",date_str,amt,"Перевод",src])]
     else:
         cls=op["Классификация"]; spec=op.get("Конкретика") or "-"
-        ws.append_row([year,month,op["Банк"],op["Операция"],date_str,op["Сумма"],cls,spec], value_input_option="USER_ENTERED")
-
-    # ←————— СОРТИРОВКИ ПО ДАТЕ —————→
-    # 1. Получаем ID листа
-    sheet_id = ws._properties['sheetId']
-    # 2. Формируем запрос
-    sort_request = {
-        "requests": [{
-            "sortRange": {
-                "range": {
-                    "sheetId":           sheet_id,
-                    "startRowIndex":     1,  # пропускаем заголовок
-                    "startColumnIndex":  0,  # А начинаес с столбца
-                    "endColumnIndex":    8,  # до H не включительно → столбец H имеет индекс 7, но endColumnIndex = 8
-                },
-                "sortSpecs": [{
-                    "dimensionIndex": 4,     # колонка E (нулевой индекс A=0, B=1, … E=4)
-                    "sortOrder":      "DESCENDING"
-                }]
-            }
-        }]
-    }
-    # 3. Отправляем запрос в API
-    ws.spreadsheet.batch_update(sort_request)
+        new_rows=[with_row_id([year,month,op["Банк"],op["Операция"],date_str,op["Сумма"],cls,spec])]
+    # ←————— ЗАПИСЬ В ОЧЕРЕДЬ —————→
+    # Строки уйдут в таблицу пакетом (каждая — на своё место по дате),
+    # пользователю отвечаем сразу; об ошибке записи очередь сообщит в чат
+    write_queue.submit(url, new_rows, bot=context.bot, chat_id=q.message.chat.id)
 
     # 1) Формируем текст карточки + подпись
     card_text = format_op(op)
@@ -434,7 +433,8 @@ async def handle_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 def register_operations_handlers(app):
     conv = ConversationHandler(
         entry_points=[CommandHandler("add", start_op)],
-        states={
+        # обработчики ниже читают черновик pending_op: если его выбросили — выходим в меню
+        states=guard_drafts({
             STATE_OP_MENU: [
                 # 1) Все menu:* коллбэки обрабатываем в handlers.menu
                 CallbackQueryHandler(handle_menu_selection, pattern="^menu:"),
@@ -463,11 +463,13 @@ def register_operations_handlers(app):
             STATE_ENTER_SPECIFIC: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, input_specific),
             ],
-        },
+        }, "pending_op", skip=(handle_menu_selection,)),
         fallbacks=[
             CallbackQueryHandler(go_main_menu, pattern="^op_cancel$"),
         ],
         allow_reentry=True,
+        # диалог не переживает свой черновик (нужен JobQueue; без него остаётся guard_drafts)
+        conversation_timeout=DRAFT_TTL,
     )
     app.add_handler(conv)
 
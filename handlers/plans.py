@@ -1,6 +1,8 @@
 # handlers/plans.py
 
+import sys
 import calendar
+from itertools import zip_longest
 from datetime import date, datetime
 from typing import Optional, Dict
 from utils.constants import STATE_PLAN_DATE
@@ -10,7 +12,15 @@ from telegram.ext import ContextTypes, CallbackQueryHandler, MessageHandler, fil
 from telegram.ext import ConversationHandler
 import math
 
-from services.sheets_service import open_finance_and_plans
+from services import metrics
+from services.sheets_gateway import open_worksheets, row_lock, sheets_call, sheets_background_call
+from services.sheets_service import insert_rows
+from services.ledger_cache import ledger_cache, insertion_index
+from services.plan_fact import PlanFact
+from services.plans_cache import plans_cache
+from services.sheets_service import TYPED_READ
+from utils.parsing import cell_date, format_amount, parse_year
+from utils.state import DRAFT_TTL, guard_drafts
 from utils.constants import (
     STATE_PLAN_MENU,
     STATE_PLAN_ADD,
@@ -22,15 +32,106 @@ from utils.constants import (
     STATE_PLAN_COPY,
     STATE_OP_MENU,
 )
-from handlers.classification import parse_sheet_date
 from handlers.operations import RU_MONTHS
 
 import asyncio
-from gspread.exceptions import APIError
 
 import logging #_____Логи
 logger = logging.getLogger(__name__) #_____Логи
 
+def _plan_sort_key(year, raw) -> int:
+    """
+    Ключ сортировки строки «Планов» по колонке E по возрастанию, как в Google:
+    сначала даты, затем нераспознанный текст, пустые ячейки — в самом низу.
+    """
+    d = cell_date(raw, parse_year(year))
+    if d is not None:
+        return d.toordinal()
+    return sys.maxsize - 1 if str(raw or "").strip() else sys.maxsize
+
+
+# Фоновые задачи синхронизации колонки «Остаток» (держим ссылки, чтобы их не собрал GC)
+_tasks: set = set()
+# Таблицы, в которых уже заменили старые формулы SUMIFS/INDIRECT на числа
+_formulas_replaced: set = set()
+
+
+def _month_plans(all_plans: list, pf: PlanFact, year: int, month: int) -> list:
+    """Планы месяца для показа; Остаток считает бот по кэшу «Финансов»."""
+    display = []
+    for r in all_plans:
+        dt = r[4]
+        if dt and dt.year == year and dt.month == month:
+            display.append({
+                "Классификация":  r[7] or "—",
+                "Сумма":          r[5] or 0.0,
+                "Остаток":        pf.remainder(year, month, r[7], r[5]),
+            })
+    return display
+
+
+def _sync_remainders(url: str, all_plans: list, pf: PlanFact) -> None:
+    """
+    В колонке G листа «Планы» лежат числа, посчитанные ботом. Если факт
+    с тех пор изменился (или в старой таблице там ещё формула) — в фоне
+    перезаписываем устаревшие ячейки одним batch_update.
+    """
+    stale = {}
+    for n, r in enumerate(all_plans, start=2):
+        dt = r[4]
+        if dt is None:
+            continue
+        rest = pf.remainder(dt.year, dt.month, r[7], r[5])
+        if r[6] is None or abs(r[6] - rest) >= 0.005:
+            stale[n] = rest
+    if not stale and url in _formulas_replaced:
+        return
+    task = asyncio.create_task(_write_remainders(url, all_plans, pf, stale))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _write_remainders(url: str, all_plans: list, pf: PlanFact, stale: Dict[int, float]) -> None:
+    """
+    Номера строк n взяты из снимка all_plans. Пишем под row_lock и только
+    если этот снимок всё ещё лежит в plans_cache: вставка плана или сортировка
+    сбрасывают кэш, и тогда G{n} попала бы в чужую строку — такую запись
+    пропускаем, остатки пересчитаются при следующем показе «Планов».
+    """
+    async with row_lock(url):
+        entry = plans_cache.peek(url)
+        if entry is None or entry.rows is not all_plans:
+            metrics.incr("plans.remainders_dropped")
+            return
+        await _write_remainders_locked(url, all_plans, pf, stale)
+
+
+async def _write_remainders_locked(url: str, all_plans: list, pf: PlanFact, stale: Dict[int, float]) -> None:
+    try:
+        _, ws_plans = await open_worksheets(url)
+        if url not in _formulas_replaced:
+            # Один раз на таблицу: находим старые формулы (волатильный INDIRECT
+            # пересчитывается при каждой правке «Финансов») и заменяем их числами
+            cells = (await sheets_background_call(
+                url, ws_plans.batch_get, ["G2:G"], value_render_option="FORMULA"
+            ))[0]
+            for n, c in enumerate(cells, start=2):
+                if c and str(c[0]).startswith("=") and n not in stale and n - 2 < len(all_plans):
+                    r = all_plans[n - 2]
+                    dt = r[4]
+                    stale[n] = pf.remainder(dt.year, dt.month, r[7], r[5]) if dt else (r[6] or 0.0)
+            _formulas_replaced.add(url)
+        if stale:
+            data = [{"range": f"G{n}", "values": [[v]]} for n, v in sorted(stale.items())]
+            await sheets_background_call(url, ws_plans.batch_update, data)
+            # те же строки лежат в plans_cache — отмечаем, что в листе уже новые числа
+            for n, v in stale.items():
+                if n - 2 < len(all_plans):
+                    all_plans[n - 2][6] = v
+    except Exception as e:
+        logger.warning("plans: не удалось обновить колонку «Остаток» %s: %s", url, e)
+
+
 def init_pending_plan(context):
     """
     Сбрасывает черновик нового плана.
@@ -83,8 +184,8 @@ async def handle_plan_fill_classification(update: Update, context: ContextTypes.
     await q.answer()
 
     # Собираем до 9 уникальных классификаций, отсортированных по алфавиту
-    _, ws_plans = open_finance_and_plans(context.user_data["sheet_url"])
-    rows = ws_plans.get_all_values()[1:]
+    url = context.user_data["sheet_url"]
+    rows = (await plans_cache.get(url)).rows
     all_cls = {r[7] for r in rows if r[7]}
     popular = sorted(all_cls)[:9]  # первые 9
 
@@ -176,6 +277,69 @@ async def handle_plan_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return await show_main_menu(update, context)
 
 
+def _plans_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("➕ Добавить",        callback_data="plans:add")],
+        [InlineKeyboardButton("🔄 Перенести планы", callback_data="plans:copy")],
+        [InlineKeyboardButton("🔙 Назад",           callback_data="plans:cancel")],
+    ])
+
+
+async def render_plans(url: str, year: int, month: int) -> str:
+    """
+    Текст экрана «Планы на месяц» со сводкой план/факт.
+    «Планы» и «Финансы» берутся из кэшей (при промахе — одним values_batch_get),
+    готовый текст кэшируется в PlansEntry по версии Ledger: повторный показ
+    без изменений не трогает ни таблицу, ни строки.
+    """
+    plans  = await plans_cache.get(url)
+    ledger = await ledger_cache.get(url)
+    text = plans.screen(year, month, ledger.version)
+    if text is not None:
+        metrics.incr("plans.screen_cached")
+        return text
+
+    # 1) Планы месяца; колонки: 0:Год, 1:Месяц, 4:Дата, 5:Сумма, 7:Классификация.
+    #    Остаток (факт − план) считаем сами по кэшу «Финансов», колонку G не читаем
+    pf = PlanFact(ledger)
+    display = _month_plans(plans.rows, pf, year, month)
+    _sync_remainders(url, plans.rows, pf)
+
+    # 2) Тело списка
+    if not display:
+        body = "— нет планов на этот месяц —"
+    else:
+        lines = [
+            f"{i}. {p['Классификация']} — {format_amount(p['Сумма'])} — {format_amount(p['Остаток'])}"
+            for i, p in enumerate(display, 1)
+        ]
+        body = "\n".join(lines)
+
+    # 3) Заголовок с русским месяцем
+    header = f"🗓 *Планы на {RU_MONTHS[month]} {year}:*\n{body}"
+
+    # 4) Сводка по планам и факту
+    def fmt(x: float) -> str:
+        s = f"{x:,.2f}"
+        return s.replace(",", "X").replace(".", ",").replace("X", " ")
+
+    plan_sum   = sum(p["Сумма"]   for p in display)
+    fact_sum   = sum(p["Остаток"] for p in display)
+    bank_total = ledger.total()
+    combined   = bank_total + fact_sum
+
+    summary = (
+        "\n\n💡 *Сводка по планам и факту:*\n"
+        f"📝 По плану: *{fmt(plan_sum)}* ₽\n"
+        f"📈 По факту: *{fmt(fact_sum)}* ₽\n"
+        f"💰 Итоговый остаток: *{fmt(combined)}* ₽"
+    )
+
+    text = header + summary
+    plans.store_screen(year, month, ledger.version, text)
+    return text
+
+
 async def start_plans(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Показываем планы на текущий месяц.
@@ -198,76 +362,9 @@ async def start_plans(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
             await update.message.reply_text("⚠️ Сначала подключите таблицу: /setup")
             return STATE_PLAN_MENU
 
-    # 1) Открываем лист «Планы» (он второй в кортеже)
-    _, ws_plans = open_finance_and_plans(url)
-    all_plans = ws_plans.get_all_values()[1:]  # пропускаем заголовок
-
     today = date.today()
-    year, month = today.year, today.month
-
-    # 2) Фильтруем планы по дате; колонки:
-    #    0:Год, 1:Месяц, 4:Дата, 5:Сумма, 6:Остаток, 7:Классификация
-    display = []
-    for r in all_plans:
-        dt = parse_sheet_date(r[4])
-        if dt and dt.year == year and dt.month == month:
-            display.append({
-                "Классификация":  r[7] or "—",
-                "Сумма":          r[5] or "0",
-                "Остаток":        r[6] or "0"
-            })
-
-    # 3) Формируем тело сообщения
-    if not display:
-        body = "— нет планов на этот месяц —"
-    else:
-        lines = [
-            f"{i}. {p['Классификация']} — {p['Сумма']} — {p['Остаток']}"
-            for i, p in enumerate(display, 1)
-        ]
-        body = "\n".join(lines)
-
-    # 4) Заголовок с русским месяцем
-    header = f"🗓 *Планы на {RU_MONTHS[month]} {year}:*\n{body}"
-
-    # —— Сводка по планам и факту для текущего месяца ——
-
-    def fmt(x: float) -> str:
-        s = f"{x:,.2f}"
-        s = s.replace(",", "X").replace(".", ",").replace("X", " ")
-        return s
-
-    # считаем суммы, предобрабатывая пробелы и NBSP
-    def to_float(s: str) -> float:
-        clean = s.replace("\xa0", "").replace(" ", "").replace(",", ".")
-        return float(clean or "0")
-
-    plan_sum  = sum(to_float(p["Сумма"])   for p in display)
-    fact_sum  = sum(to_float(p["Остаток"]) for p in display)
-
-    fin_ws, _   = open_finance_and_plans(url)
-    fin_rows    = fin_ws.get_all_values()[1:]
-    bank_total  = sum(to_float(r[5])      for r in fin_rows if r[5])
-
-    combined = bank_total + fact_sum
-
-    summary = (
-        "\n\n💡 *Сводка по планам и факту:*\n"
-        f"📝 По плану: *{fmt(plan_sum)}* ₽\n"
-        f"📈 По факту: *{fmt(fact_sum)}* ₽\n"
-        f"💰 Итоговый остаток: *{fmt(combined)}* ₽"
-    )
-
-    # 5) Кнопки
-    kb = [
-        [InlineKeyboardButton("➕ Добавить",        callback_data="plans:add")],
-        [InlineKeyboardButton("🔄 Перенести планы", callback_data="plans:copy")],
-        [InlineKeyboardButton("🔙 Назад",           callback_data="plans:cancel")],
-    ]
-
-    # 6) Выводим список + сводку + клавиатуру
-    text = header + summary
-    markup = InlineKeyboardMarkup(kb)
+    text = await render_plans(url, today.year, today.month)
+    markup = _plans_keyboard()
 
     if q:
         try:
@@ -438,34 +535,37 @@ async def handle_plan_save(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     )
 
     url = context.user_data.get("sheet_url")
-    _, ws_plans = open_finance_and_plans(url)
+    _, ws_plans = await open_worksheets(url)
 
     row = context.user_data["pending_plan"]
 
-    # 1) Формула для колонки "Остаток"
-    formula = (
-        f'=SUMIFS(Финансы!$F:$F;Финансы!$G:$G;INDIRECT("H"&ROW());'
-        f'Финансы!$B:$B;INDIRECT("B"&ROW());Финансы!$A:$A;INDIRECT("A"&ROW()))'
-        f'-INDIRECT("F"&ROW())'
-    )
+    # 1) Остаток (факт − план) считаем сами по кэшу «Финансов» и пишем числом
+    dt = datetime.strptime(row["Дата"], "%d.%m.%Y").date()
+    pf = PlanFact(await ledger_cache.get(url))
+    remainder = pf.remainder(dt.year, dt.month, row["Классификация"], row["Сумма"])
 
     # 2) Новая строка
     new_row = [
         row["Год"], row["Месяц"], row["Банк"],
         row["Операция"], row["Дата"], row["Сумма"],
-        formula,
+        remainder,
         row["Классификация"], row["Конкретика"]
     ]
 
-    # 3) Добавляем и сразу сортируем лист "Планы" по дате (5-й столбец, E)
-    ws_plans.append_row(new_row, value_input_option="USER_ENTERED")
-    try:
-        # gspread: сортируем по колонке E (index=5) возрастанию
-        ws_plans.sort((5, 'asc'))
-    except Exception as e:
-        logger.error(f"Ошибка сортировки листа «Планы»: {e}")
+    # 3) Вставляем строку сразу на своё место: лист "Планы" отсортирован по дате (E) по возрастанию.
+    #    Вставка сдвигает строки — под row_lock, чтобы фоновая запись «Остатка» не попала мимо
+    async with row_lock(url):
+        years, dates = await sheets_call(url, ws_plans.batch_get, ["A2:A", "E2:E"], **TYPED_READ)
+        keys = [
+            _plan_sort_key(y[0] if y else "", d[0] if d else "")
+            for y, d in zip_longest(years, dates)
+        ]
+        idx = insertion_index(keys, _plan_sort_key(row["Год"], row["Дата"]))
+        await sheets_call(url, insert_rows, ws_plans, [(idx + 2, new_row)])
+        # строка уже на своём месте — ждать сортировку не нужно, достаточно сбросить кэш «Планов»
+        plans_cache.invalidate(url)
 
-        # 4) Сообщение-подтверждение (отдельное новое сообщение)
+    # 4) Сообщение-подтверждение (отдельное новое сообщение)
     await q.message.reply_text("✅ План успешно добавлен.")
 
     # 4.1) Сразу «закрываем» карточку, чтобы убрать клавиатуру
@@ -474,95 +574,19 @@ async def handle_plan_save(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     except Exception as e:
         logger.warning("Не удалось скрыть карточку плана: %s", e)
 
-    # 4.2) Небольшая пауза — даём таблице/сортировке примениться
-    await asyncio.sleep(0.8)
-
-    # 4.3) Отправляем «Планы» ОТДЕЛЬНЫМ сообщением (чтобы оно было ПОСЛЕДНИМ)
-    async def send_plans_fresh():
-        url = context.user_data.get("sheet_url")
-        _, ws_plans = open_finance_and_plans(url)
-        all_plans = ws_plans.get_all_values()[1:]
-
+    # 4.2) Отправляем «Планы» ОТДЕЛЬНЫМ сообщением (чтобы оно было ПОСЛЕДНИМ);
+    #      429 и квоты Google Sheets обрабатывает services.quota внутри sheets_call
+    try:
         today = date.today()
-        year, month = today.year, today.month
-
-        # соберём строки текущего месяца
-        display = []
-        for r in all_plans:
-            dt = parse_sheet_date(r[4])
-            if dt and dt.year == year and dt.month == month:
-                display.append({
-                    "Классификация":  r[7] or "—",
-                    "Сумма":          r[5] or "0",
-                    "Остаток":        r[6] or "0"
-                })
-
-        # тело списка
-        if not display:
-            body = "— нет планов на этот месяц —"
-        else:
-            lines = [
-                f"{i}. {p['Классификация']} — {p['Сумма']} — {p['Остаток']}"
-                for i, p in enumerate(display, 1)
-            ]
-            body = "\n".join(lines)
-
-        # заголовок
-        header = f"🗓 *Планы на {RU_MONTHS[month]} {year}:*\n{body}"
-
-        # сводка
-        def fmt(x: float) -> str:
-            s = f"{x:,.2f}"
-            return s.replace(",", "X").replace(".", ",").replace("X", " ")
-
-        def to_float(s: str) -> float:
-            clean = s.replace("\xa0", "").replace(" ", "").replace(",", ".")
-            return float(clean or "0")
-
-        fin_ws, _ = open_finance_and_plans(url)
-        fin_rows   = fin_ws.get_all_values()[1:]
-        plan_sum   = sum(to_float(p["Сумма"])   for p in display)
-        fact_sum   = sum(to_float(p["Остаток"]) for p in display)
-        bank_total = sum(to_float(r[5]) for r in fin_rows if r[5])
-        combined   = bank_total + fact_sum
-
-        summary = (
-            "\n\n💡 *Сводка по планам и факту:*\n"
-            f"📝 По плану: *{fmt(plan_sum)}* ₽\n"
-            f"📈 По факту: *{fmt(fact_sum)}* ₽\n"
-            f"💰 Итоговый остаток: *{fmt(combined)}* ₽"
-        )
-
-        # клавиатура «Планов»
-        kb = [
-            [InlineKeyboardButton("➕ Добавить",        callback_data="plans:add")],
-            [InlineKeyboardButton("🔄 Перенести планы", callback_data="plans:copy")],
-            [InlineKeyboardButton("🔙 Назад",           callback_data="plans:cancel")],
-        ]
-
-        # отправляем НОВОЕ сообщение (а не редактируем старое)
+        text = await render_plans(url, today.year, today.month)
         await context.bot.send_message(
             chat_id=q.message.chat.id,
-            text=header + summary,
+            text=text,
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(kb)
+            reply_markup=_plans_keyboard()
         )
-
-    # Аккуратные ретраи на случай 429 от Google Sheets
-    for delay in (0.0, 1.0, 2.0):
-        try:
-            await send_plans_fresh()
-            break
-        except APIError as e:
-            code = getattr(getattr(e, "response", None), "status_code", None)
-            if code == 429:
-                logger.warning("Sheets 429, повтор через %.1fs", max(delay, 1.0))
-                await asyncio.sleep(max(delay, 1.0))
-                continue
-            raise
-        except Exception as e:
-            logger.exception("Не удалось отправить «Планы»: %s", e)
-            break
+    except Exception as e:
+        logger.exception("Не удалось отправить «Планы»: %s", e)
 
     return STATE_PLAN_MENU
 
@@ -572,14 +596,14 @@ async def handle_plan_save(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def handle_plan_copy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Шаг 3: копируем планы прошлого месяца на текущий,
-    обновляем год/месяц и вбрасываем формулу остатка.
+    обновляем год/месяц и записываем остаток числом.
     """
     q = update.callback_query
     await q.answer()
 
     url = context.user_data.get("sheet_url")
-    _, ws_plans = open_finance_and_plans(url)
-    rows = ws_plans.get_all_values()[1:]
+    _, ws_plans = await open_worksheets(url)
+    rows = (await plans_cache.get(url)).rows
 
     today = date.today()
     prev_month = today.month - 1 or 12
@@ -591,22 +615,20 @@ async def handle_plan_copy(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     new_year  = str(today.year)
     new_month = RU_MONTHS[today.month]  # по‑русски
 
+    pf = PlanFact(await ledger_cache.get(url))
+
     to_copy = []
     for r in rows:
-        old_dt = parse_sheet_date(r[4])
+        old_dt = r[4]
         if not (old_dt and old_dt.year == prev_year and old_dt.month == prev_month):
             continue
 
         cls   = r[7]  # классификация
-        plan  = r[5]  # плановая сумма как строка
+        plan  = "" if r[5] is None else r[5]  # плановая сумма (число)
         spec  = r[8]  # конкретика
 
-        # Формула остатка: SUMIFS по "Финансы" минус INDIRECT("F"&ROW())
-        formula = (
-            f'=SUMIFS(Финансы!$F:$F;Финансы!$G:$G;INDIRECT("H"&ROW());'
-            f'Финансы!$B:$B;INDIRECT("B"&ROW());Финансы!$A:$A;INDIRECT("A"&ROW()))'
-            f'-INDIRECT("F"&ROW())'
-        )
+        # Остаток: факт текущего месяца по классификации минус план
+        remainder = pf.remainder(today.year, today.month, cls, r[5])
 
         new_row = [
             new_year,         # год текущего месяца
@@ -615,14 +637,15 @@ async def handle_plan_copy(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             r[3],             # Операция ("План")
             new_date,         # дата — последний день текущего месяца
             plan,             # сумма (строка или число)
-            formula,          # остаток — динамическая формула
+            remainder,        # остаток — число, посчитанное ботом
             cls,              # классификация
             spec,             # конкретика
         ]
         to_copy.append(new_row)
 
     if to_copy:
-        ws_plans.append_rows(to_copy, value_input_option="USER_ENTERED")
+        await sheets_call(url, ws_plans.append_rows, to_copy, value_input_option="USER_ENTERED")
+        plans_cache.invalidate(url)
         # краткое уведомление (можно опустить, если не нужно)
         await q.edit_message_text("🔄 Планы перенесены на текущий месяц.")
     else:
@@ -647,7 +670,8 @@ def register_plans_handlers(app):
         entry_points=[
             CallbackQueryHandler(start_plans, pattern=r"^menu:plans$")
         ],
-        states={
+        # карточка плана читает черновик pending_plan: если его выбросили — выходим в меню
+        states=guard_drafts({
             STATE_PLAN_MENU: [
                 # ➕ Добавить
                 CallbackQueryHandler(handle_plan_add,     pattern=r"^plans:add$"),
@@ -680,10 +704,12 @@ def register_plans_handlers(app):
             STATE_PLAN_SPECIFIC: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_plan_specific)
             ],
-        },
+        }, "pending_plan", skip=(handle_plan_add, handle_plan_copy, handle_plan_cancel)),
         fallbacks=[
             CallbackQueryHandler(handle_plan_cancel, pattern=r"^plans:cancel$")
         ],
         allow_reentry=True,
+        # диалог не переживает свой черновик (нужен JobQueue; без него остаётся guard_drafts)
+        conversation_timeout=DRAFT_TTL,
     )
     app.add_handler(conv)
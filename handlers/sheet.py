@@ -10,7 +10,10 @@ from telegram.ext import (
     filters
 )
 from utils.constants           import STATE_SHEET
-from services.sheets_service   import open_finance_and_plans
+from services.sheets_service   import invalidate_worksheets, provision_spreadsheet
+from services.sheets_gateway   import sheets_call
+from services.ledger_cache     import ledger_cache
+from services.plans_cache      import plans_cache
 
 async def show_sheet_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         # Если тариф не выбран — не даём перейти на этот этап
@@ -45,8 +48,10 @@ async def handle_sheet_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         )
         return STATE_SHEET
 
+    # листы таблицы настраиваются заново — старую пару из кэша процесса не используем
+    invalidate_worksheets(url)
     try:
-        finance_ws, plans_ws = open_finance_and_plans(url)
+        finance_ws, plans_ws = await sheets_call(url, provision_spreadsheet, url)
     except Exception as e:
         # Показываем реальную ошибку для диагностики
         await update.message.reply_text(
@@ -59,6 +64,10 @@ async def handle_sheet_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         )
         return STATE_SHEET
 
+    # настройка пересортировала листы — кэши строк больше не соответствуют таблице
+    ledger_cache.invalidate(url)
+    plans_cache.invalidate(url)
+
     context.user_data["sheet_url"] = url
     await update.message.reply_text(
         "✅ Таблица успешно подключена и инициализирована!\n"
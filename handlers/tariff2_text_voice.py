@@ -3,11 +3,12 @@
 # Этап 4: Тариф 2 (текст + голос) → ИИ → JSON → карточка → запись в Google Sheets
 # ======================================================
 
-import os
 import io
 import json
+import logging
 import re
-from datetime import datetime
+from collections import Counter, OrderedDict
+from datetime import date, datetime, timedelta
 from typing import Optional, Dict, Any, List
 from utils.caps import has_cap
 
@@ -19,13 +20,14 @@ from telegram.ext import ContextTypes, MessageHandler, CallbackQueryHandler, fil
 from pydub import AudioSegment
 import speech_recognition as sr
 
-# ИИ (OpenAI SDK 1.x)
-try:
-    from openai import OpenAI
-except ImportError:
-    OpenAI = None
+# ИИ (OpenAI SDK 1.x) — общий асинхронный клиент
+from services import openai_client
+from services.llm_cache import llm_cache
+from services.write_queue import write_queue
+from services import metrics
+from services.ledger_cache import ledger_cache, with_row_id
 
-from services.sheets_service import open_finance_and_plans
+logger = logging.getLogger(__name__)
 
 # -----------------------------
 # 0) УТИЛИТЫ: формат, эмодзи, валидация
@@ -190,12 +192,9 @@ SYSTEM_PROMPT = (
 async def gpt_to_json(user_text: str) -> Any:
     """
     Отправляем текст в OpenAI и возвращаем распарсенный JSON (dict или list).
+    Запрос ожидается асинхронно через общий клиент — остальные пользователи не ждут.
     """
-    if OpenAI is None:
-        raise RuntimeError("Библиотека openai не установлена. Установи пакет `openai`.")
-
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    resp = client.chat.completions.create(
+    resp = await openai_client.chat_completion(
         model="gpt-4o-mini",
         temperature=0.1,
         messages=[
@@ -256,6 +255,291 @@ def normalize_result(data: Any) -> List[Dict[str, Any]]:
 
     return ops
 
+# -----------------------------
+# 1.1) Кэш разбора: одинаковые фразы («кофе 250») не отправляем в модель повторно
+# -----------------------------
+
+# Явная дата в тексте: «05.06», «5/6», название месяца
+_RE_EXPLICIT_DATE = re.compile(
+    r"\d{1,2}[./-]\d{1,2}|январ|феврал|март|апрел|\bма(?:й|я|е|ю|ем)\b|июн|июл|август|сентябр|октябр|ноябр|декабр"
+)
+# День недели: «в пятницу» — дата зависит и от сегодняшнего дня недели
+_RE_WEEKDAY = re.compile(
+    r"понедельник|вторник|\bсред[аеуы]\b|четверг|пятниц|суббот|воскресень"
+)
+_RE_SPACES = re.compile(r"\s+")
+
+
+def _cache_key(text: str, today: date) -> str:
+    """
+    Нормализованный текст + контекст даты. Без явной даты результат зависит
+    только от «сегодня», поэтому даты храним сдвигом в днях («rel») и ключ
+    не меняется день ото дня; с явной датой — важен год («2025»);
+    с днём недели сдвиг зависит от того, какой сегодня день, — ключ
+    привязан к самой дате («2025-06-05»).
+    """
+    norm = _RE_SPACES.sub(" ", text.lower().replace("ё", "е")).strip(" .!,;")
+    if _RE_WEEKDAY.search(norm):
+        ctx = today.isoformat()
+    elif _RE_EXPLICIT_DATE.search(norm):
+        ctx = str(today.year)
+    else:
+        ctx = "rel"
+    return f"{ctx}|{norm}"
+
+
+def _to_cached(ops: List[Dict[str, Any]], key: str, today: date) -> List[Dict[str, Any]]:
+    if not key.startswith("rel|"):
+        return ops
+    out = []
+    for op in ops:
+        op = dict(op)
+        op["Дата"] = (date.fromisoformat(op["Дата"]) - today).days
+        out.append(op)
+    return out
+
+
+def _from_cached(ops: List[Dict[str, Any]], key: str, today: date) -> List[Dict[str, Any]]:
+    if not key.startswith("rel|"):
+        return ops
+    for op in ops:
+        dt = today + timedelta(days=op["Дата"])
+        op["Дата"]  = dt.isoformat()
+        op["Год"]   = dt.year
+        op["Месяц"] = RU_MONTHS[dt.month-1]
+    return ops
+
+
+# -----------------------------
+# 1.2) Быстрый разбор по правилам: «250 кофе», «такси 400 тинькофф вчера»
+# -----------------------------
+
+# Сумма: «250», «1200,50», «1.5к», «300р»
+_RE_AMOUNT = re.compile(r"^[+-]?(\d+(?:[.,]\d{1,2})?)(к|k|р|руб|₽)?$")
+# Дата: «05.06», «5.6.2025»
+_RE_DAY_MONTH = re.compile(r"^(\d{1,2})\.(\d{1,2})(?:\.(\d{2}|\d{4}))?$")
+# Группы разрядов: «1 200», «100 000» — первая группа и следующие по три цифры
+_RE_GROUP_HEAD = re.compile(r"^[+-]?(\d{1,3})$")
+_RE_GROUP_TAIL = re.compile(r"^(\d{3})(к|k|р|руб|₽)?$")
+# Дата словами: «5 июня», «в мае», «завтра», «на прошлой неделе», «3 дня назад» —
+# такие даты разбирает модель (сами понимаем только «сегодня»/«вчера»/«позавчера»)
+_RE_DATE_WORD = re.compile(
+    r"^(январ|феврал|март|апрел|июн|июл|август|сентябр|октябр|ноябр|декабр"
+    r"|завтра|послезавтра|недел|месяц|прошл|позапрошл|следующ|выходн|назад|числ)"
+    r"|^ма(й|я|е|ю|ем)$|^год(а|у)?$"
+)
+_RELATIVE_DAYS = {"сегодня": 0, "вчера": -1, "позавчера": -2}
+_INCOME_WORDS = {"пополнение", "зарплата", "зп", "доход", "получил", "получила", "кэшбек", "кешбэк", "кешбек"}
+# Такие сообщения разбираем только моделью
+_LLM_ONLY_WORDS = {"перевод", "перевел", "перевела", "перевёл", "план"}
+
+# Словари пользователя по его листу «Финансы»: url → (версия Ledger, словарь)
+_VOCABULARY: "OrderedDict[str, tuple]" = OrderedDict()
+_VOCABULARY_MAX = 1000
+
+
+def _vocabulary(url: str, ledger) -> dict:
+    """
+    Известные банки и классификации пользователя, самая частая
+    классификация для каждой «Конкретики» и модель классификаций Ledger
+    (для незнакомых формулировок). Пересобирается при изменении Ledger.
+    """
+    cached = _VOCABULARY.get(url)
+    if cached is not None and cached[0] == ledger.version:
+        _VOCABULARY.move_to_end(url)
+        return cached[1]
+
+    cat = ledger.cats[6]
+    by_specific: Dict[str, Counter] = {}
+    for spec, code in zip(ledger.specifics, cat.codes):
+        cls = cat.values[code].strip()
+        key = spec.strip().casefold()
+        if key and cls:
+            by_specific.setdefault(key, Counter())[cls] += 1
+    vocab = {
+        "banks":     {b.strip().casefold(): b for b in ledger.value_counts(2) if b.strip()},
+        "classes":   {c.strip().casefold(): c for c in ledger.value_counts(6) if c.strip()},
+        "specifics": {k: c.most_common(1)[0][0] for k, c in by_specific.items()},
+        "model":     ledger.classifier,
+    }
+    _VOCABULARY[url] = (ledger.version, vocab)
+    _VOCABULARY.move_to_end(url)
+    while len(_VOCABULARY) > _VOCABULARY_MAX:
+        _VOCABULARY.popitem(last=False)
+    return vocab
+
+
+def _take_phrase(words: List[str], known: Dict[str, str]) -> Optional[str]:
+    """
+    Ищет среди слов известное значение (банк/классификацию): сначала целиком
+    (в том числе из нескольких слов), затем по началу слова («тинь» → «Тинькофф»).
+    Найденные слова удаляются из words.
+    """
+    low = [w.casefold() for w in words]
+    for key in sorted(known, key=len, reverse=True):
+        parts = key.split()
+        for i in range(len(low) - len(parts) + 1):
+            if low[i:i + len(parts)] == parts:
+                del words[i:i + len(parts)]
+                return known[key]
+    for i, w in enumerate(low):
+        if len(w) < 4:
+            continue
+        matches = [v for k, v in known.items() if " " not in k and (k.startswith(w) or w.startswith(k))]
+        if len(matches) == 1:
+            del words[i]
+            return matches[0]
+    return None
+
+
+def _join_thousands(words: List[str]) -> Optional[List[str]]:
+    """
+    Склеивает сумму, записанную группами разрядов: «1 200» → «1200»,
+    «100 000» → «100000». Однозначно это только если первая группа короче
+    трёх цифр или все следующие — «000»; «250 300» может быть и двумя суммами —
+    тогда None (разбирает модель). Даты и дробные числа не склеиваются.
+    """
+    out, i = [], 0
+    while i < len(words):
+        head = _RE_GROUP_HEAD.match(words[i])
+        tail = []
+        j = i + 1
+        while head and j < len(words):
+            m = _RE_GROUP_TAIL.match(words[j].casefold())
+            if not m:
+                break
+            tail.append(m)
+            j += 1
+            if m.group(2):
+                # у группы есть «р»/«к» — сумма закончилась
+                break
+        if not tail:
+            out.append(words[i])
+            i += 1
+            continue
+        if len(head.group(1)) > 2 and any(m.group(1) != "000" for m in tail):
+            return None
+        out.append(words[i] + "".join(m.group(0) for m in tail))
+        i = j
+    return out
+
+
+def rule_parse(text: str, vocab: dict, today: date) -> Optional[List[Dict[str, Any]]]:
+    """
+    Разбор типовых сообщений без модели: сумма, необязательные банк, слово
+    операции и дата, классификация (известная пользователю — названием, через
+    «Конкретику» или по модели его истории). Возвращает то же, что normalize_result, или None, если
+    уверенности нет (нет суммы, их несколько или сумма неоднозначна, перевод,
+    дата словами, неизвестный банк или классификация).
+    """
+    words = [w.strip(",;!?") for w in text.split()]
+    words = _join_thousands([w for w in words if w])
+    if words is None:
+        return None
+    low = {w.casefold().replace("ё", "е") for w in words}
+    if low & _LLM_ONLY_WORDS:
+        return None
+    # «в пятницу», «5 июня», «завтра» — дату считает модель
+    if _RE_WEEKDAY.search(" ".join(low)) or any(_RE_DATE_WORD.match(w) for w in low):
+        return None
+
+    # 1) Дата и сумма. «05.06» без года — дата, только если рядом есть ещё число (сумма),
+    #    иначе это сумма 5,06
+    numbers = sum(1 for w in words if _RE_AMOUNT.match(w.casefold()))
+    amounts, day, rest = [], None, []
+    for w in words:
+        lw = w.casefold()
+        if lw in _RELATIVE_DAYS:
+            day = today + timedelta(days=_RELATIVE_DAYS[lw])
+            continue
+        m = _RE_DAY_MONTH.match(w)
+        if m and day is None and (m.group(3) or numbers > 1):
+            try:
+                y = int(m.group(3)) if m.group(3) else today.year
+                day = date(y + 2000 if y < 100 else y, int(m.group(2)), int(m.group(1)))
+                continue
+            except ValueError:
+                pass
+        m = _RE_AMOUNT.match(lw)
+        if m:
+            amount = float(m.group(1).replace(",", "."))
+            amounts.append(amount * 1000 if m.group(2) in ("к", "k") else amount)
+            continue
+        rest.append(w)
+    if len(amounts) != 1:
+        return None
+
+    # 2) Операция
+    operation = "Трата"
+    kept = []
+    for w in rest:
+        if w.casefold() in _INCOME_WORDS:
+            operation = "Пополнение"
+        else:
+            kept.append(w)
+    rest = kept
+
+    # 3) Банк и классификация
+    bank = _take_phrase(rest, vocab["banks"])
+    if bank is None:
+        # банк не назван: если он у пользователя один — он и есть,
+        # иначе операция без банка не попала бы ни в один остаток
+        banks = list(vocab["banks"].values())
+        if len(banks) != 1:
+            return None
+        bank = banks[0]
+    cls = _take_phrase(rest, vocab["classes"])
+    specific = " ".join(rest)
+    if cls is None:
+        cls = vocab["specifics"].get(specific.casefold())
+    if cls is None and specific and vocab.get("model") is not None:
+        guess = vocab["model"].predict(specific)
+        if guess:
+            cls = guess[0]
+            metrics.incr("t2.class_predicted")
+    if cls is None:
+        return None
+
+    day = day or today
+    return normalize_result({
+        "Год": day.year, "Месяц": RU_MONTHS[day.month-1],
+        "Банк": bank, "Операция": operation, "Дата": day.isoformat(),
+        "Сумма": amounts[0], "Классификация": cls, "Конкретика": specific,
+    })
+
+
+async def parse_operations(user_text: str, url: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Текст → список операций (как normalize_result(gpt_to_json(...))):
+    1) разбор по правилам со словарём пользователя (url — его таблица);
+    2) кэш llm_cache — повторная фраза без обращения к модели;
+    3) модель.
+    """
+    today = date.today()
+    if url:
+        try:
+            ops = rule_parse(user_text, _vocabulary(url, await ledger_cache.get(url)), today)
+        except Exception as e:
+            logger.warning("rule_parse: %r: %s", user_text, e)
+            ops = None
+        if ops:
+            metrics.incr("t2.rule_parsed")
+            return ops
+
+    key = _cache_key(user_text, today)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return _from_cached(cached, key, today)
+
+    ops = normalize_result(await gpt_to_json(user_text))
+    if ops:
+        try:
+            llm_cache.put(key, _to_cached(ops, key, today))
+        except Exception as e:
+            # кэш — не повод не показать карточку
+            logger.warning("llm_cache: не удалось сохранить %r: %s", key, e)
+    return ops
+
 # -----------------------------
 # 2) ХЕНДЛЕРЫ: текст и голос
 # -----------------------------
@@ -281,8 +565,7 @@ async def tariff2_text_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
     await update.message.reply_chat_action("typing")
     try:
-        data = await gpt_to_json(txt)
-        ops = normalize_result(data)
+        ops = await parse_operations(txt, context.user_data.get("sheet_url"))
         if not ops:
             return await update.message.reply_text("Не удалось распознать операцию. Сформулируй иначе.")
 
@@ -341,8 +624,7 @@ async def tariff2_voice_handler(update: Update, context: ContextTypes.DEFAULT_TY
     # Дальше — как с текстом
     await update.message.reply_chat_action("typing")
     try:
-        data = await gpt_to_json(text_ru)
-        ops = normalize_result(data)
+        ops = await parse_operations(text_ru, context.user_data.get("sheet_url"))
         if not ops:
             return await update.message.reply_text("Не удалось распознать операцию из речи.")
 
@@ -394,16 +676,17 @@ async def t2_confirm_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not sheet_url:
         return await q.edit_message_text("Сначала подключите таблицу (Этап 2).")
 
-    ws_fin, _ = open_finance_and_plans(sheet_url)
-
     # Этап 4.4: запись всех строк (учитываем случай «Перевод» — у нас ops уже может быть длиной 2)
-    for op in ops:
-        row = [
+    # — одним пакетом через очередь записи, подтверждаем сразу
+    rows = [
+        with_row_id([
             op.get("Год"), op.get("Месяц"), op.get("Банк"),
             op.get("Операция"), op.get("Дата"), op.get("Сумма"),
             op.get("Классификация"), op.get("Конкретика")
-        ]
-        ws_fin.append_row(row, value_input_option="USER_ENTERED")
+        ])
+        for op in ops
+    ]
+    write_queue.submit(sheet_url, rows, bot=context.bot, chat_id=q.message.chat.id)
 
     context.user_data.pop("t2_ops_pending", None)
     await q.edit_message_text(f"✅ Добавлено строк: {len(ops)}")
@@ -0,0 +1,50 @@
+# services/balances.py — материализованные остатки по банкам для экрана «Финансы»
+
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+
+def _cents(amount: float) -> int:
+    """Суммы храним в копейках: дельты складываются без накопления ошибки float."""
+    return int(round(amount * 100))
+
+
+class BalanceView:
+    """
+    Остаток по каждому банку одной таблицы.
+    Строится один раз при загрузке листа и дальше меняется только на дельту
+    каждой добавленной/изменённой/удалённой строки — ответ за O(число банков).
+    """
+
+    def __init__(self, pairs: Iterable[Tuple[str, Optional[float]]] = ()):
+        self._cents: Dict[str, int] = {}
+        self._rows: Dict[str, int] = {}   # сколько строк у банка — чтобы убирать пустые
+        self.validated_at = time.monotonic()
+        for bank, amount in pairs:
+            self.add(bank, amount)
+
+    def add(self, bank: str, amount: Optional[float]) -> None:
+        if not bank or amount is None:
+            return
+        self._cents[bank] = self._cents.get(bank, 0) + _cents(amount)
+        self._rows[bank] = self._rows.get(bank, 0) + 1
+
+    def remove(self, bank: str, amount: Optional[float]) -> None:
+        if not bank or amount is None:
+            return
+        self._cents[bank] = self._cents.get(bank, 0) - _cents(amount)
+        self._rows[bank] = self._rows.get(bank, 0) - 1
+        if self._rows[bank] <= 0:
+            self._cents.pop(bank, None)
+            self._rows.pop(bank, None)
+
+    def snapshot(self) -> Dict[str, float]:
+        """{банк: остаток} в рублях."""
+        return {bank: c / 100 for bank, c in self._cents.items()}
+
+    def total(self) -> float:
+        return sum(self._cents.values()) / 100
+
+    def matches(self, other: "BalanceView") -> bool:
+        """Совпадают ли остатки с другим (например, пересчитанным с листа) представлением."""
+        return self._cents == other._cents
@@ -0,0 +1,118 @@
+# services/change_detect.py — дешёвая проверка «таблицу правили вручную» для кэшей листов
+
+import os
+import time
+import logging
+from typing import Callable, Dict, List, Optional
+
+from services import metrics, sheets_gateway
+from services.sheets_gateway import open_worksheets, sheets_call
+
+logger = logging.getLogger(__name__)
+
+# Источник сигнала: drive — modifiedTime файла из Drive API; local — подставной (тесты); none — выключено
+SIGNAL = os.getenv("SHEETS_CHANGE_SIGNAL", "drive")
+# Не чаще одного запроса сигнала на таблицу за столько секунд
+CHECK_INTERVAL = float(os.getenv("SHEETS_CHANGE_CHECK_INTERVAL", "30"))
+
+
+class ChangeSignal:
+    """Источник версии таблицы: строка, которая меняется при любой правке."""
+
+    async def fetch(self, url: str) -> str:
+        raise NotImplementedError
+
+
+class DriveModifiedTime(ChangeSignal):
+    """modifiedTime файла из метаданных Drive — один маленький запрос вместо get_all_values."""
+
+    async def fetch(self, url: str) -> str:
+        ws, _ = await open_worksheets(url)
+        return await sheets_call(url, ws.spreadsheet.get_lastUpdateTime)
+
+
+class LocalSignal(ChangeSignal):
+    """Подставной источник без Google: версия таблицы меняется вызовом touch(url)."""
+
+    def __init__(self):
+        self.versions: Dict[str, int] = {}
+
+    def touch(self, url: str) -> None:
+        self.versions[url] = self.versions.get(url, 0) + 1
+
+    async def fetch(self, url: str) -> str:
+        return str(self.versions.get(url, 0))
+
+
+class _State:
+    def __init__(self, token: Optional[str], checked_at: float):
+        self.token = token
+        self.checked_at = checked_at
+
+
+class ChangeDetector:
+    """
+    Перед тем как верить кэшу листа, обработчик зовёт check(url): раз в interval
+    секунд запрашиваем сигнал, и если он изменился — вызываем подписчиков
+    (invalidate кэшей), чтобы при следующем обращении лист перечитался.
+    Правки самого бота тоже меняют сигнал; если с прошлой проверки была запись
+    через sheets_gateway, новое значение принимаем без сброса — кэши и так
+    обновлены write-through. Ручная правка, попавшая в тот же интервал, будет
+    подхвачена по TTL кэша.
+    Все методы вызываются из цикла событий бота.
+    """
+
+    def __init__(self, signal: Optional[ChangeSignal], interval: float = CHECK_INTERVAL):
+        self.signal = signal
+        self.interval = interval
+        self._states: Dict[str, _State] = {}
+        self._subscribers: List[Callable[[str], None]] = []
+
+    def subscribe(self, callback: Callable[[str], None]) -> None:
+        """callback(url) вызывается, когда таблицу url изменили не через бота."""
+        self._subscribers.append(callback)
+
+    async def check(self, url: str) -> bool:
+        """True — таблицу правили вручную, кэши сброшены."""
+        if self.signal is None:
+            return False
+        now = time.monotonic()
+        state = self._states.get(url)
+        if state is not None and now - state.checked_at < self.interval:
+            return False
+
+        # отмечаем проверку сразу, чтобы параллельные обращения не запрашивали сигнал повторно
+        prev_token = state.token if state else None
+        prev_checked = state.checked_at if state else now
+        self._states[url] = _State(prev_token, now)
+        try:
+            token = await self.signal.fetch(url)
+        except Exception as e:
+            logger.warning("change_detect: не удалось получить сигнал %s: %s", url, e)
+            return False
+        self._states[url].token = token
+        metrics.incr("change_detect.checks")
+
+        if prev_token is None or token == prev_token:
+            return False
+        if sheets_gateway.last_write.get(url, float("-inf")) >= prev_checked:
+            metrics.incr("change_detect.own_write")
+            return False
+
+        metrics.incr("change_detect.changed")
+        logger.info("change_detect: таблица %s изменена вне бота — сбрасываем кэши", url)
+        for callback in self._subscribers:
+            callback(url)
+        return True
+
+
+def _make_signal(name: str) -> Optional[ChangeSignal]:
+    if name == "drive":
+        return DriveModifiedTime()
+    if name == "local":
+        return LocalSignal()
+    return None
+
+
+# Общий детектор на процесс
+change_detector = ChangeDetector(_make_signal(SIGNAL))
@@ -0,0 +1,133 @@
+# services/classifier.py — угадывание «Классификации» по «Конкретике» на истории самого пользователя
+
+import os
+import re
+import sys
+import math
+from typing import Dict, List, Optional, Tuple
+
+# С какой уверенностью (0–1) подсказка считается ответом
+MIN_CONFIDENCE = float(os.getenv("CLASSIFIER_MIN_CONFIDENCE", "0.6"))
+# Сколько раз класс должен встретиться, чтобы его предлагать
+MIN_CLASS_ROWS = int(os.getenv("CLASSIFIER_MIN_CLASS_ROWS", "2"))
+
+# Служебные классификации — их не предлагаем
+IGNORED_CLASSES = ("Перевод", "Старт")
+# Длина основы слова: «такси»/«таксист», «продукты»/«продуктов» совпадают
+_STEM = 5
+_RE_WORD = re.compile(r"[a-zа-я0-9]+")
+# Оценка памяти на новую пару (слово, класс) в словарях модели, байт
+_CELL_BYTES = 100
+
+
+def tokens(text: str) -> List[str]:
+    """«Такси до Дома» → ['такси', 'до', 'дома']: нижний регистр, ё → е, основы без чисел."""
+    words = _RE_WORD.findall(text.casefold().replace("ё", "е"))
+    return list({w[:_STEM] for w in words if len(w) >= 2 and not w.isdigit()})
+
+
+class CategoryModel:
+    """
+    Наивный Байес (мультиномиальный, сглаживание Лапласа) «Конкретика» → «Классификация»
+    по строкам одной таблицы. Хранит только счётчики, поэтому обучение —
+    один проход по строкам, а add()/remove() меняют модель на одну строку.
+    Доля класса в истории не учитывается (равные априорные вероятности):
+    иначе редкий класс не выигрывает даже по слову, которое встречалось только с ним.
+    predict() возвращает (класс, вероятность) или None, если уверенности нет
+    или в тексте нет ни одного знакомого слова.
+    """
+
+    def __init__(self):
+        self._rows: Dict[str, int] = {}                 # класс → строк
+        self._words: Dict[str, int] = {}                # класс → слов во всех его строках
+        self._counts: Dict[str, Dict[str, int]] = {}    # слово → {класс: сколько раз}
+        self.nbytes = 0
+
+    def __len__(self) -> int:
+        return sum(self._rows.values())
+
+    @staticmethod
+    def _usable(specific: str, cls: str) -> bool:
+        return bool(cls.strip()) and cls not in IGNORED_CLASSES and specific.strip() not in ("", "-")
+
+    def add(self, specific: str, cls: str) -> int:
+        """Учитывает строку; возвращает прирост памяти."""
+        if not self._usable(specific, cls):
+            return 0
+        words = tokens(specific)
+        if not words:
+            return 0
+        grown = 0
+        self._rows[cls] = self._rows.get(cls, 0) + 1
+        self._words[cls] = self._words.get(cls, 0) + len(words)
+        for w in words:
+            by_class = self._counts.get(w)
+            if by_class is None:
+                by_class = self._counts[w] = {}
+                grown += sys.getsizeof(w)
+            if cls not in by_class:
+                grown += _CELL_BYTES
+            by_class[cls] = by_class.get(cls, 0) + 1
+        self.nbytes += grown
+        return grown
+
+    def remove(self, specific: str, cls: str) -> None:
+        """Забывает строку, учтённую раньше через add()."""
+        if not self._usable(specific, cls):
+            return
+        words = tokens(specific)
+        if not words or cls not in self._rows:
+            return
+        self._rows[cls] -= 1
+        self._words[cls] -= len(words)
+        if self._rows[cls] <= 0:
+            del self._rows[cls], self._words[cls]
+        for w in words:
+            by_class = self._counts.get(w)
+            if by_class is None or cls not in by_class:
+                continue
+            by_class[cls] -= 1
+            if by_class[cls] <= 0:
+                del by_class[cls]
+                if not by_class:
+                    del self._counts[w]
+
+    def ranked(self, text: str) -> List[Tuple[str, float]]:
+        """
+        [(класс, вероятность), ...] по убыванию — только классы, которые
+        встречались хотя бы с одним словом текста. Остальные классы входят
+        в нормировку одним «прочим» (лучшим из них): иначе при полутора десятках
+        классов уверенность размазывалась бы по ним, даже если слово
+        встречалось только с одним. Пусто, если свидетельств нет ни у одного
+        класса или «прочий» набирает больше лучшего из них.
+        """
+        classes = [c for c, n in self._rows.items() if n >= MIN_CLASS_ROWS]
+        words = [
+            w for w in tokens(text)
+            if w in self._counts and any(c in self._counts[w] for c in classes)
+        ]
+        if not words or not classes:
+            return []
+        vocab = len(self._counts)
+        scores = {}
+        for c in classes:
+            denom = math.log(self._words[c] + vocab)
+            score = 0.0
+            for w in words:
+                score += math.log(self._counts[w].get(c, 0) + 1) - denom
+            scores[c] = score
+        evidence = {c: s for c, s in scores.items() if any(c in self._counts[w] for w in words)}
+        other = max((s for c, s in scores.items() if c not in evidence), default=None)
+        best = max(evidence.values())
+        if other is not None and other >= best:
+            return []
+        # softmax без переполнения
+        exp = {c: math.exp(s - best) for c, s in evidence.items()}
+        norm = sum(exp.values()) + (math.exp(other - best) if other is not None else 0.0)
+        return sorted(((c, e / norm) for c, e in exp.items()), key=lambda p: p[1], reverse=True)
+
+    def predict(self, text: str, min_confidence: float = MIN_CONFIDENCE) -> Optional[Tuple[str, float]]:
+        ranked = self.ranked(text)
+        if ranked and ranked[0][1] >= min_confidence:
+            return ranked[0]
+        return None
@@ -0,0 +1,69 @@
+# services/google_client.py — общий на весь процесс клиент Google Sheets
+
+import os
+import threading
+import logging
+
+import gspread
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+
+# Размер пула keep-alive соединений к googleapis.com
+POOL_SIZE = int(os.getenv("GOOGLE_HTTP_POOL_SIZE", "20"))
+
+# Реестр клиентов: путь к ключу сервисного аккаунта → gspread.Client
+_CLIENTS: dict = {}
+_LOCK = threading.Lock()
+
+
+def _build_client(creds_path: str) -> gspread.Client:
+    """
+    Читает JSON-ключ один раз и собирает клиента.
+    AuthorizedSession внутри gspread сам обновляет OAuth-токен,
+    только когда тот близок к истечению, — поэтому объект Credentials
+    должен жить столько же, сколько процесс.
+    """
+    creds = Credentials.from_service_account_file(creds_path, scopes=SCOPES)
+    client = gspread.authorize(creds)
+
+    # Один пул соединений на всех пользователей: TLS-рукопожатие платим один раз
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    client.http_client.session.mount("https://", adapter)
+    return client
+
+
+def get_client(creds_path: str = None) -> gspread.Client:
+    """
+    Возвращает общий клиент для сервисного аккаунта (по умолчанию —
+    из GOOGLE_APPLICATION_CREDENTIALS), создавая его при первом обращении.
+    """
+    creds_path = creds_path or os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+    with _LOCK:
+        client = _CLIENTS.get(creds_path)
+        if client is not None:
+            metrics.incr("google_client.hit")
+            return client
+
+        metrics.incr("google_client.miss")
+        logger.info("google_client: создаём клиента для %s", creds_path)
+        client = _build_client(creds_path)
+        _CLIENTS[creds_path] = client
+        return client
+
+
+def stats() -> dict:
+    """Счётчики попаданий/промахов реестра клиентов."""
+    return {
+        "hits":    metrics.get("google_client.hit"),
+        "misses":  metrics.get("google_client.miss"),
+        "clients": len(_CLIENTS),
+    }
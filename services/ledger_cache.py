@@ -0,0 +1,580 @@
+# services/ledger_cache.py — кэш листа «Финансы» в памяти процесса
+
+import os
+import sys
+import time
+import asyncio
+import heapq
+import itertools
+import math
+import uuid
+import logging
+from array import array
+from collections import OrderedDict
+from itertools import zip_longest
+from datetime import date
+from typing import Dict, List, Optional
+
+from services import metrics
+from services.balances import BalanceView
+from services.change_detect import change_detector
+from services.classifier import CategoryModel
+from services.rollup import MonthlyRollup
+from services.sheets_gateway import open_worksheets, row_lock, sheets_call, sheets_background_call
+from services.sheets_service import write_row_ids
+from services.sheets_service import TYPED_READ
+from utils.parsing import cell_amount, cell_date, format_amount, format_sheet_date, parse_year
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд кэш считается устаревшим (подхватываем ручные правки в таблице)
+TTL = float(os.getenv("LEDGER_CACHE_TTL", "300"))
+# Общий бюджет памяти на все таблицы, байт
+MAX_BYTES = int(os.getenv("LEDGER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Как часто сверять материализованные остатки по банкам с самим листом, секунд
+BALANCE_CHECK_INTERVAL = float(os.getenv("BALANCE_CHECK_INTERVAL", "900"))
+
+# Колонки листа «Финансы»: Год, Месяц, Банк, Операция, Дата, Сумма, Классификация, Конкретика
+# и скрытая колонка I — ID строки, по которому бот находит её для правки/удаления
+WIDTH = 9
+ID_COL = 8
+
+NAN = float("nan")
+
+# Сквозной счётчик версий: у каждого Ledger после любого изменения строк — новая версия
+_VERSIONS = itertools.count(1)
+
+
+def new_row_id() -> str:
+    """
+    Короткий уникальный ID строки. Начинается с буквы, чтобы USER_ENTERED
+    не принял его за число (например, «12e3…»).
+    """
+    return "r" + uuid.uuid4().hex[:11]
+
+
+def with_row_id(row) -> list:
+    """Строка A:H + новый ID в колонке I."""
+    row = list(row)[:ID_COL]
+    return row + [""] * (ID_COL - len(row)) + [new_row_id()]
+
+
+def _text(value) -> str:
+    """Ячейка как текст: целые числа без «.0» (Год 2025, а не 2025.0)."""
+    if type(value) is str:
+        return value
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _sort_key(d: Optional[date], raw: str) -> int:
+    """
+    Ключ сортировки «как в Google» для колонки E по убыванию:
+    нераспознанный текст — выше всех дат, пустые ячейки — в самом низу.
+    """
+    if d is not None:
+        return d.toordinal()
+    return sys.maxsize if raw.strip() else -sys.maxsize
+
+
+def insertion_index(keys, key: int, descending: bool = False) -> int:
+    """
+    Индекс для вставки key в упорядоченную последовательность keys —
+    после всех равных, как если бы строку дописали в конец и отсортировали
+    устойчивой сортировкой. keys — любая индексируемая последовательность.
+    """
+    lo, hi = 0, len(keys)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if (keys[mid] >= key) if descending else (keys[mid] <= key):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class _Categories:
+    """
+    Текстовая колонка с повторяющимися значениями (Банк, Классификация, …):
+    каждое значение хранится один раз, у строки — только его код в array.
+    counts — сколько строк сейчас ссылается на значение.
+    """
+
+    def __init__(self):
+        self.values: List[str] = []
+        self.counts: List[int] = []
+        self.lookup: dict = {}
+        self.codes = array("i")
+
+    def code(self, value: str) -> int:
+        c = self.lookup.get(value)
+        if c is None:
+            c = self.lookup[value] = len(self.values)
+            self.values.append(value)
+            self.counts.append(0)
+        return c
+
+    def insert(self, idx: int, value: str) -> int:
+        """Вставляет значение; возвращает прирост памяти (новое значение в словаре)."""
+        c = self.lookup.get(value)
+        grown = 0
+        if c is None:
+            c = self.code(value)
+            grown = sys.getsizeof(value)
+        self.codes.insert(idx, c)
+        self.counts[c] += 1
+        return grown
+
+    def pop(self, idx: int) -> str:
+        c = self.codes.pop(idx)
+        self.counts[c] -= 1
+        return self.values[c]
+
+    def __getitem__(self, idx: int) -> str:
+        return self.values[self.codes[idx]]
+
+
+# Колонки-категории: Год, Месяц, Банк, Операция, нераспознанный текст Даты и Суммы, Классификация
+_CATEGORY_COLS = (0, 1, 2, 3, 4, 5, 6)
+# Память строки без учёта строк-значений: коды категорий, дата, сумма, ссылки на Конкретику и ID
+_ROW_FIXED_BYTES = 4 * len(_CATEGORY_COLS) + 8 + 8 + 8 * 2
+
+
+class Ledger:
+    """
+    Разобранное содержимое листа «Финансы» одной таблицы в колоночном виде.
+    Строка i — строка листа с номером i + 2 (первая строка — шапка):
+      keys[i]    — ключ сортировки по Дате (ordinal даты; ±sys.maxsize — текст/пусто),
+      amounts[i] — Сумма (float, NaN — пусто или не число),
+      cats[c]    — коды категорий колонки c (см. _CATEGORY_COLS); для Даты и Суммы
+                   там лежит только нераспознанный текст, иначе пустая строка,
+      specifics / ids — Конкретика и ID строки.
+    Строка для показа собирается по запросу (row()).
+    balances — остатки по банкам, rollup — помесячные суммы по Классификации;
+    оба меняются вместе со строками; classifier — модель «Конкретика» →
+    «Классификация», обучается при первом обращении и дальше тоже идёт в ногу;
+    _index — ID → индекс строки; пересобирается лениво после вставок/удалений.
+    version — меняется при каждом изменении строк (ключ для кэшей производных данных).
+    """
+
+    def __init__(self, rows: List[list]):
+        self.keys = array("q")
+        self.amounts = array("d")
+        self.cats = {c: _Categories() for c in _CATEGORY_COLS}
+        self.specifics: List[str] = []
+        self.ids: List[str] = []
+        self.balances = BalanceView()
+        self.rollup = MonthlyRollup()
+        self.nbytes = 0
+        self.loaded_at = time.monotonic()
+        self._index: Optional[dict] = None
+        self._classifier: Optional[CategoryModel] = None
+        self.version = next(_VERSIONS)
+        for r in rows:
+            self._insert(len(self.keys), r)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    # —————— внутренние операции над строкой ——————
+
+    @staticmethod
+    def _decode(row) -> tuple:
+        """
+        Строка листа (типизированное чтение: числа и серийные даты, или то,
+        что записал бот) → (текстовые ячейки, дата, сумма).
+        """
+        cells = list(row)[:WIDTH]
+        cells += [""] * (WIDTH - len(cells))
+        text = [_text(c) for c in cells]
+        d = cell_date(cells[4], parse_year(text[0]))
+        amount = cell_amount(cells[5])
+        return text, d, amount
+
+    def _insert(self, idx: int, row) -> None:
+        text, d, amount = self._decode(row)
+        self.keys.insert(idx, _sort_key(d, text[4]))
+        self.amounts.insert(idx, NAN if amount is None else amount)
+        # распознанные Дата/Сумма живут в keys/amounts, в категориях — только «сырой» текст
+        if d is not None:
+            text[4] = ""
+        if amount is not None:
+            text[5] = ""
+        grown = 0
+        for c in _CATEGORY_COLS:
+            grown += self.cats[c].insert(idx, sys.intern(text[c]))
+        spec = sys.intern(text[7])
+        self.specifics.insert(idx, spec)
+        self.ids.insert(idx, text[ID_COL])
+        self.balances.add(text[2], amount)
+        self.rollup.add(d, text[6], amount)
+        if self._classifier is not None:
+            grown += self._classifier.add(spec, text[6])
+        self.nbytes += _ROW_FIXED_BYTES + grown + sys.getsizeof(text[ID_COL])
+        self._index = None
+        self.version = next(_VERSIONS)
+
+    def _pop(self, idx: int) -> list:
+        row = self.row(idx)
+        key = self.keys.pop(idx)
+        amount = self.amounts.pop(idx)
+        for c in _CATEGORY_COLS:
+            self.cats[c].pop(idx)
+        self.specifics.pop(idx)
+        row_id = self.ids.pop(idx)
+        amount = None if amount != amount else amount
+        self.balances.remove(row[2], amount)
+        d = date.fromordinal(key) if -sys.maxsize < key < sys.maxsize else None
+        self.rollup.remove(d, row[6], amount)
+        if self._classifier is not None:
+            self._classifier.remove(row[7], row[6])
+        self.nbytes -= _ROW_FIXED_BYTES + sys.getsizeof(row_id)
+        self._index = None
+        self.version = next(_VERSIONS)
+        return row
+
+    # —————— запись «в ногу» с изменениями в таблице ——————
+
+    def append(self, rows: List[list]) -> None:
+        """Строки дописаны в конец листа (append_row/append_rows)."""
+        for r in rows:
+            self._insert(len(self.keys), r)
+
+    def insert(self, placed: List[tuple]) -> None:
+        """Строки вставлены на свои места (insert_rows) — [(номер_строки, строка), ...]."""
+        for row_number, row in placed:
+            self._insert(row_number - 2, row)
+
+    def update(self, row_number: int, row) -> None:
+        """Строка row_number перезаписана целиком (A:H) — ID в колонке I остаётся прежним."""
+        idx = row_number - 2
+        index = self._index
+        row = list(row)[:ID_COL]
+        row += [""] * (ID_COL - len(row)) + [self._pop(idx)[ID_COL]]
+        self._insert(idx, row)
+        # строки не сдвинулись — индекс ID остаётся верным
+        self._index = index
+
+    def delete(self, row_number: int) -> None:
+        """Строка row_number удалена (delete_rows) — нижние сдвигаются вверх."""
+        self._pop(row_number - 2)
+
+    def move(self, from_row: int, to_row: int) -> None:
+        """Строка перенесена (move_row): после переноса она — строка to_row."""
+        self._insert(to_row - 2, self._pop(from_row - 2))
+
+    def sorted_position(self, row_number: int) -> int:
+        """
+        Где должна стоять строка row_number, чтобы лист остался отсортированным
+        по колонке E по убыванию (например, после правки даты). Тот же номер —
+        строка уже на месте.
+        """
+        idx = row_number - 2
+        keys, key = self.keys, self.keys[row_number - 2]
+        if (idx == 0 or keys[idx - 1] >= key) and (idx == len(keys) - 1 or key >= keys[idx + 1]):
+            return row_number
+        rest = keys[:idx] + keys[idx + 1:]
+        return insertion_index(rest, key, descending=True) + 2
+
+    def resort(self) -> None:
+        """
+        Повторяет у себя sortRange по колонке E по убыванию
+        (сортировка устойчивая, как и в Google Sheets).
+        """
+        # sorted(reverse=True) сохраняет исходный порядок равных элементов
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__, reverse=True)
+        self.keys    = array("q", (self.keys[i] for i in order))
+        self.amounts = array("d", (self.amounts[i] for i in order))
+        for cat in self.cats.values():
+            cat.codes = array("i", (cat.codes[i] for i in order))
+        self.specifics = [self.specifics[i] for i in order]
+        self.ids       = [self.ids[i] for i in order]
+        self._index    = None
+
+    def assign_missing_ids(self) -> int:
+        """Выдаёт ID строкам, у которых его нет (старые записи). Возвращает число таких строк."""
+        missing = 0
+        for i, row_id in enumerate(self.ids):
+            if not row_id and any(self.row(i)[:ID_COL]):
+                self.ids[i] = new_row_id()
+                missing += 1
+        if missing:
+            self._index = None
+        return missing
+
+    # —————— чтение ——————
+
+    @property
+    def classifier(self) -> CategoryModel:
+        """Модель классификаций по истории таблицы; обучается при первом обращении."""
+        if self._classifier is None:
+            started = time.perf_counter()
+            model = CategoryModel()
+            cat = self.cats[6]
+            for spec, code in zip(self.specifics, cat.codes):
+                model.add(spec, cat.values[code])
+            self._classifier = model
+            self.nbytes += model.nbytes
+            metrics.incr("classifier.trained")
+            logger.debug(
+                "ledger_cache: модель классификаций обучена на %d строках за %.1f мс",
+                len(model), (time.perf_counter() - started) * 1000,
+            )
+        return self._classifier
+
+    def row(self, idx: int) -> list:
+        """Строка idx для показа: Дата и Сумма — в формате листа («7 июня, пт», «1 234,56»)."""
+        key, amount = self.keys[idx], self.amounts[idx]
+        row = [self.cats[c][idx] for c in _CATEGORY_COLS] + [self.specifics[idx], self.ids[idx]]
+        if -sys.maxsize < key < sys.maxsize:
+            row[4] = format_sheet_date(date.fromordinal(key))
+        if amount == amount:
+            row[5] = format_amount(amount)
+        return row
+
+    @property
+    def rows(self) -> List[list]:
+        """Все строки для показа (собираются заново — для редких полных проходов)."""
+        return [self.row(i) for i in range(len(self.keys))]
+
+    def column(self, idx: int) -> list:
+        """Значения одной колонки (0 — Год, …, 7 — Конкретика)."""
+        if idx in (4, 5):
+            return [self.row(i)[idx] for i in range(len(self.keys))]
+        if idx in self.cats:
+            cat = self.cats[idx]
+            return [cat.values[c] for c in cat.codes]
+        return list(self.specifics if idx == 7 else self.ids)
+
+    def value_counts(self, idx: int) -> Dict[str, int]:
+        """{значение: число строк} для колонки-категории (Банк, Классификация, …)."""
+        cat = self.cats[idx]
+        return {v: n for v, n in zip(cat.values, cat.counts) if n > 0}
+
+    def total(self) -> float:
+        """Сумма колонки F по всем строкам."""
+        return math.fsum(a for a in self.amounts if a == a)
+
+    def row_number(self, row_id: str) -> Optional[int]:
+        """Номер строки листа по её ID (None — такой строки нет)."""
+        if not row_id:
+            return None
+        if self._index is None:
+            self._index = {r: i for i, r in enumerate(self.ids) if r}
+        idx = self._index.get(row_id)
+        return None if idx is None else idx + 2
+
+    def insertion_points(self, rows: List[list]) -> List[tuple]:
+        """
+        Куда вставить новые строки, чтобы лист остался отсортированным
+        по колонке E по убыванию. Кэш не меняется.
+        Возвращает [(номер_строки, строка), ...] для insert_rows() и insert():
+        номер каждой строки учитывает строки, вставленные перед ней.
+        """
+        placed, new_keys = [], []
+        for row in rows:
+            text, d, _ = self._decode(row)
+            key = _sort_key(d, text[4])
+            idx = insertion_index(self.keys, key, descending=True)
+            # уже вставленные строки с тем же или более поздним ключом окажутся выше
+            idx += sum(1 for k in new_keys if k >= key)
+            new_keys.append(key)
+            placed.append((idx + 2, row))
+        return placed
+
+    def latest(self, n: int, bank: str = None) -> List[tuple]:
+        """
+        n самых свежих операций (по колонке E, как после сортировки листа),
+        при равных датах — в порядке строк листа. Лист при этом не трогаем.
+        Возвращает [(номер_строки, строка), ...]; bank — фильтр по колонке C.
+        """
+        idxs = range(len(self.keys))
+        if bank is not None:
+            code = self.cats[2].lookup.get(bank)
+            codes = self.cats[2].codes
+            idxs = [i for i in idxs if codes[i] == code]
+        keys = self.keys
+        top = heapq.nsmallest(n, idxs, key=lambda i: (-keys[i], i))
+        return [(i + 2, self.row(i)) for i in top]
+
+
+class LedgerCache:
+    """
+    Кэш Ledger по URL таблицы с TTL и общим бюджетом памяти.
+    При превышении бюджета вытесняются таблицы, к которым дольше всего не обращались.
+    Все методы вызываются из цикла событий бота, поэтому замки не нужны.
+    """
+
+    def __init__(self, ttl: float = TTL, max_bytes: int = MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Ledger]" = OrderedDict()
+        self._tasks: set = set()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(e.nbytes for e in self._entries.values())
+
+    def _fresh(self, url: str) -> Optional[Ledger]:
+        entry = self._entries.get(url)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.loaded_at > self.ttl:
+            del self._entries[url]
+            return None
+        return entry
+
+    async def get(self, url: str, locked: bool = False) -> Ledger:
+        """
+        Ledger таблицы: из памяти или (при промахе/истечении TTL) одним get_all_values.
+        Читаем без форматирования: суммы — числами, даты — серийными номерами,
+        так что год есть у каждой даты и строки не нужно разбирать.
+        Чтение и дозапись ID идут под row_lock(url), чтобы вставка из очереди
+        записи не сдвинула строки между ними; locked=True — вызывающий
+        уже держит этот замок (row_lock не реентерабелен).
+        """
+        if self._fresh(url) is not None:
+            # таблицу правили вручную — детектор сбросит кэш через подписку
+            await change_detector.check(url)
+        entry = self._fresh(url)
+        if entry is not None:
+            metrics.incr("ledger_cache.hit")
+            self._entries.move_to_end(url)
+            return entry
+
+        if locked:
+            return await self._read(url)
+        async with row_lock(url):
+            # пока ждали замок, таблицу мог перечитать другой запрос
+            entry = self._fresh(url)
+            if entry is not None:
+                metrics.incr("ledger_cache.hit")
+                return entry
+            return await self._read(url)
+
+    async def _read(self, url: str) -> Ledger:
+        metrics.incr("ledger_cache.miss")
+        ws, _ = await open_worksheets(url)
+        values = await sheets_call(url, ws.get_all_values, **TYPED_READ)
+        return await self.load(url, values)
+
+    def peek(self, url: str) -> Optional[Ledger]:
+        """Ledger из памяти, если он есть и не устарел; без обращения к таблице."""
+        return self._fresh(url)
+
+    async def load(self, url: str, values: List[list]) -> Ledger:
+        """
+        Положить в кэш уже прочитанный лист «Финансы» (с шапкой, типизированное
+        чтение) — например, полученный вместе с «Планами» одним values_batch_get.
+        Вызывать под row_lock(url), взятым до чтения: ID строк дописываются
+        по номерам строк прочитанного снимка.
+        """
+        ws, _ = await open_worksheets(url)
+        entry = Ledger(values[1:])
+        if entry.assign_missing_ids():
+            # Старые строки без ID: дописываем колонку I одним запросом
+            try:
+                await sheets_call(url, write_row_ids, ws, entry.column(ID_COL))
+            except Exception as e:
+                logger.warning("ledger_cache: не удалось записать ID строк %s: %s", url, e)
+        self._entries[url] = entry
+        self._entries.move_to_end(url)
+        self._evict(keep=url)
+        return entry
+
+    async def balances(self, url: str) -> BalanceView:
+        """
+        Остатки по банкам без пересчёта строк. Раз в BALANCE_CHECK_INTERVAL
+        в фоне сверяем их с колонками C и F самого листа.
+        """
+        entry = await self.get(url)
+        view = entry.balances
+        if time.monotonic() - view.validated_at > BALANCE_CHECK_INTERVAL:
+            view.validated_at = time.monotonic()
+            task = asyncio.create_task(self._validate_balances(url, entry))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return view
+
+    async def _validate_balances(self, url: str, entry: Ledger) -> None:
+        try:
+            ws, _ = await open_worksheets(url)
+            banks, amounts = await sheets_background_call(
+                url, ws.batch_get, ["C2:C", "F2:F"], value_render_option="UNFORMATTED_VALUE"
+            )
+        except Exception as e:
+            logger.warning("ledger_cache: не удалось сверить остатки %s: %s", url, e)
+            return
+        banks = [r[0] if r else "" for r in banks]
+        amounts = [cell_amount(r[0]) if r else None for r in amounts]
+        fresh = BalanceView(zip_longest(banks, amounts))
+        if not fresh.matches(entry.balances):
+            metrics.incr("ledger_cache.balance_mismatch")
+            logger.warning("ledger_cache: остатки %s разошлись с листом — перечитываем", url)
+            if self._entries.get(url) is entry:
+                self.invalidate(url)
+
+    def _evict(self, keep: str = None) -> None:
+        total = self.nbytes
+        while total > self.max_bytes and len(self._entries) > 1:
+            url, entry = next(iter(self._entries.items()))
+            if url == keep:
+                self._entries.move_to_end(url)
+                continue
+            del self._entries[url]
+            total -= entry.nbytes
+            metrics.incr("ledger_cache.evicted")
+            logger.info("ledger_cache: вытеснена таблица %s (%d байт)", url, entry.nbytes)
+
+    # —————— write-through: вызываются после успешной записи в таблицу ——————
+
+    def append(self, url: str, rows: List[list], resort: bool = False) -> None:
+        entry = self._entries.get(url)
+        if entry is None:
+            return
+        entry.append(rows)
+        if resort:
+            entry.resort()
+        self._evict(keep=url)
+
+    def insert(self, url: str, placed: List[tuple]) -> None:
+        entry = self._entries.get(url)
+        if entry is None:
+            return
+        entry.insert(placed)
+        self._evict(keep=url)
+
+    def update(self, url: str, row_number: int, row) -> None:
+        entry = self._entries.get(url)
+        if entry is not None:
+            entry.update(row_number, row)
+
+    def delete(self, url: str, row_number: int) -> None:
+        entry = self._entries.get(url)
+        if entry is not None:
+            entry.delete(row_number)
+
+    def move(self, url: str, from_row: int, to_row: int) -> None:
+        entry = self._entries.get(url)
+        if entry is not None:
+            entry.move(from_row, to_row)
+
+    def resort(self, url: str) -> None:
+        entry = self._entries.get(url)
+        if entry is not None:
+            entry.resort()
+
+    def invalidate(self, url: str = None) -> None:
+        """Сбросить кэш таблицы (или весь кэш)."""
+        if url is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(url, None)
+
+
+# Общий экземпляр на процесс
+ledger_cache = LedgerCache()
+change_detector.subscribe(ledger_cache.invalidate)
@@ -0,0 +1,85 @@
+# services/llm_cache.py — кэш результатов разбора текста моделью (переживает перезапуск)
+
+import os
+import json
+import time
+import sqlite3
+import logging
+from typing import Any, Optional
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Файл кэша; пустая строка — кэш только в памяти процесса
+PATH     = os.getenv("LLM_CACHE_PATH", "data/llm_cache.sqlite3")
+# Сколько секунд запись считается верной
+TTL      = float(os.getenv("LLM_CACHE_TTL", str(30 * 24 * 3600)))
+# Сколько записей хранить; при превышении удаляются давно не использованные
+MAX_ROWS = int(os.getenv("LLM_CACHE_MAX_ROWS", "20000"))
+# Раз в сколько новых записей проверять размер кэша
+_PRUNE_EVERY = 100
+
+
+class LLMCache:
+    """
+    Ключ (нормализованный текст + контекст даты) → JSON-значение, в SQLite.
+    Запись живёт TTL секунд с момента сохранения; при превышении MAX_ROWS
+    удаляются записи, к которым дольше всего не обращались.
+    Попадания/промахи — в метриках llm_cache.hit / llm_cache.miss.
+    """
+
+    def __init__(self, path: str = PATH, ttl: float = TTL, max_rows: int = MAX_ROWS):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self._inserts = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self._conn.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > self.ttl:
+            metrics.incr("llm_cache.miss")
+            return None
+        self._conn.execute("UPDATE llm_cache SET used = ? WHERE key = ?", (now, key))
+        metrics.incr("llm_cache.hit")
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, value, created, used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), now, now),
+        )
+        self._inserts += 1
+        if self._inserts % _PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self) -> None:
+        """Удаляет просроченные записи и лишние сверх max_rows."""
+        self._conn.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM llm_cache WHERE key IN ("
+            " SELECT key FROM llm_cache ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (self.max_rows,),
+        )
+
+    def stats(self) -> dict:
+        """Попадания, промахи, доля попаданий и число записей."""
+        return {
+            "hits":     metrics.get("llm_cache.hit"),
+            "misses":   metrics.get("llm_cache.miss"),
+            "hit_rate": metrics.hit_rate("llm_cache"),
+            "rows":     self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0],
+        }
+
+
+# Общий экземпляр на процесс
+llm_cache = LLMCache()
@@ -0,0 +1,34 @@
+# services/metrics.py — простые счётчики процесса (попадания кэшей, обращения к API и т.п.)
+
+import threading
+from collections import defaultdict
+
+_COUNTERS = defaultdict(int)
+_LOCK = threading.Lock()
+
+
+def incr(name: str, value: int = 1) -> None:
+    """Увеличивает счётчик name на value."""
+    with _LOCK:
+        _COUNTERS[name] += value
+
+
+def get(name: str) -> int:
+    """Текущее значение счётчика (0, если его ещё не было)."""
+    with _LOCK:
+        return _COUNTERS.get(name, 0)
+
+
+def snapshot(prefix: str = "") -> dict:
+    """Копия всех счётчиков (или только начинающихся с prefix)."""
+    with _LOCK:
+        return {k: v for k, v in _COUNTERS.items() if k.startswith(prefix)}
+
+
+def hit_rate(prefix: str) -> float:
+    """Доля попаданий для пары счётчиков <prefix>.hit / <prefix>.miss."""
+    with _LOCK:
+        hits = _COUNTERS.get(f"{prefix}.hit", 0)
+        misses = _COUNTERS.get(f"{prefix}.miss", 0)
+    total = hits + misses
+    return hits / total if total else 0.0
@@ -0,0 +1,74 @@
+# services/openai_client.py — общий на весь процесс асинхронный клиент OpenAI
+
+import os
+import asyncio
+import logging
+
+# ИИ (OpenAI SDK 1.x); httpx приходит вместе с ним
+try:
+    import httpx
+    from openai import AsyncOpenAI
+except ImportError:
+    httpx = None
+    AsyncOpenAI = None
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Таймауты запроса к модели, секунд
+TIMEOUT         = float(os.getenv("OPENAI_TIMEOUT", "30"))
+CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+# Повторы самого SDK (429/5xx/обрыв соединения)
+MAX_RETRIES     = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+# Размер пула keep-alive соединений к api.openai.com
+POOL_SIZE       = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+# Сколько запросов к модели может выполняться одновременно (по всем пользователям)
+MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+
+_client = None
+_semaphore = None
+
+
+def get_client():
+    """
+    Возвращает общий AsyncOpenAI, создавая его при первом обращении:
+    один пул соединений на процесс — TLS-рукопожатие платим один раз.
+    """
+    global _client
+    if AsyncOpenAI is None:
+        raise RuntimeError("Библиотека openai не установлена. Установи пакет `openai`.")
+    if _client is None:
+        logger.info("openai_client: создаём клиента (пул %d, таймаут %.0fs)", POOL_SIZE, TIMEOUT)
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+            timeout=httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT),
+        )
+        _client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            max_retries=MAX_RETRIES,
+            http_client=http_client,
+        )
+    return _client
+
+
+async def chat_completion(**kwargs):
+    """
+    client.chat.completions.create(**kwargs) с ограничением одновременных
+    запросов MAX_CONCURRENCY. Цикл событий не блокируется.
+    """
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    client = get_client()
+    async with _semaphore:
+        metrics.incr("openai.requests")
+        return await client.chat.completions.create(**kwargs)
+
+
+async def close() -> None:
+    """Закрывает пул соединений (вызывается при завершении бота)."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
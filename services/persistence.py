@@ -0,0 +1,196 @@
+# services/persistence.py — хранение user_data/chat_data/диалогов в SQLite построчно
+
+import os
+import json
+import pickle
+import sqlite3
+import logging
+from typing import Dict, Iterator, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from services import metrics
+from utils.state import DURABLE_KEYS, UserState
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data     (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data     (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS kv            (key TEXT PRIMARY KEY,   data BLOB);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL,
+                                          PRIMARY KEY (name, key));
+"""
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence для PTB: у каждого пользователя/чата — своя строка в SQLite (WAL).
+    - при старте ничего не загружаем: get_user_data()/get_chat_data() отдают пустые
+      словари, а данные конкретного пользователя подгружаются в refresh_user_data(),
+      который PTB вызывает перед обработкой его апдейта;
+    - PTB передаёт в update_user_data() только тех, кого трогали с прошлой записи;
+      дополнительно не пишем строку, если её содержимое не изменилось.
+    Поэтому старт и запись не зависят от общего числа пользователей.
+    Если user_data — UserState, сохраняются только постоянные ключи (DURABLE_KEYS),
+    черновики и кэши остаются в памяти.
+    migrate_from — файл PicklePersistence: переносится один раз, если база пустая.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        store_data: PersistenceInput = None,
+        update_interval: float = 60,
+        migrate_from: Optional[str] = None,
+    ):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath = filepath
+        self._conn = sqlite3.connect(filepath, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # кого уже подгрузили из базы, и хэш последней записанной строки
+        self._loaded: Dict[Tuple[str, int], int] = {}
+        if migrate_from and os.path.exists(migrate_from) and self._is_empty():
+            self._import_pickle(migrate_from)
+
+    # —————— внутреннее ——————
+
+    def _is_empty(self) -> bool:
+        for table in ("user_data", "chat_data", "kv", "conversations"):
+            if self._conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    def _import_pickle(self, path: str) -> None:
+        """Однократный перенос состояния из файла PicklePersistence."""
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        with self._conn:
+            self._conn.execute("BEGIN")
+            for table in ("user_data", "chat_data"):
+                for key, data in (state.get(table) or {}).items():
+                    self._conn.execute(
+                        f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)",
+                        (key, pickle.dumps(data)),
+                    )
+            for key in ("bot_data", "callback_data"):
+                if state.get(key) is not None:
+                    self._put_kv(key, state[key])
+            for name, conv in (state.get("conversations") or {}).items():
+                for key, new_state in conv.items():
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                        (name, json.dumps(list(key)), pickle.dumps(new_state)),
+                    )
+        logger.info("persistence: состояние перенесено из %s в %s", path, self.filepath)
+
+    def _get_kv(self, key: str):
+        row = self._conn.execute("SELECT data FROM kv WHERE key = ?", (key,)).fetchone()
+        return pickle.loads(row[0]) if row and row[0] is not None else None
+
+    def _put_kv(self, key: str, data) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO kv (key, data) VALUES (?, ?)", (key, pickle.dumps(data))
+        )
+
+    def _refresh(self, table: str, key: int, data: dict) -> None:
+        """Подгружает строку в словарь PTB при первом обращении к пользователю/чату."""
+        if isinstance(data, UserState):
+            data.touch()
+        if (table, key) in self._loaded:
+            return
+        row = self._conn.execute(f"SELECT data FROM {table} WHERE id = ?", (key,)).fetchone()
+        if row:
+            stored = pickle.loads(row[0])
+            if isinstance(data, UserState):
+                # строки, перенесённые из PicklePersistence, могут содержать старые черновики
+                stored = {k: v for k, v in stored.items() if k in DURABLE_KEYS}
+            data.update(stored)
+            self._loaded[(table, key)] = hash(row[0])
+            metrics.incr(f"persistence.{table}.loaded")
+        else:
+            self._loaded[(table, key)] = 0
+
+    def _update(self, table: str, key: int, data: dict) -> None:
+        if isinstance(data, UserState):
+            data = data.durable()
+        if (table, key) not in self._loaded and not data:
+            # словарь так и не подгружали и он пуст — не затираем сохранённую строку
+            return
+        blob = pickle.dumps(data)
+        digest = hash(blob)
+        if self._loaded.get((table, key)) == digest:
+            return
+        self._conn.execute(f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)", (key, blob))
+        self._loaded[(table, key)] = digest
+        metrics.incr(f"persistence.{table}.written")
+
+    def _drop(self, table: str, key: int) -> None:
+        self._conn.execute(f"DELETE FROM {table} WHERE id = ?", (key,))
+        self._loaded.pop((table, key), None)
+
+    def iter_user_data(self) -> Iterator[Tuple[int, dict]]:
+        """Сохранённые user_data всех пользователей (в том числе не подгруженных) — для фоновых задач."""
+        for key, blob in self._conn.execute("SELECT id, data FROM user_data"):
+            yield key, pickle.loads(blob)
+
+    # —————— BasePersistence ——————
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return self._get_kv("bot_data") or {}
+
+    async def get_callback_data(self):
+        return self._get_kv("callback_data")
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = self._conn.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(k)): pickle.loads(s) for k, s in rows}
+
+    async def update_conversation(self, name: str, key, new_state: Optional[object]) -> None:
+        k = json.dumps(list(key))
+        if new_state is None:
+            self._conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, k))
+        else:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                (name, k, pickle.dumps(new_state)),
+            )
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._update("user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._update("chat_data", chat_id, data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._put_kv("bot_data", data)
+
+    async def update_callback_data(self, data) -> None:
+        self._put_kv("callback_data", data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._drop("user_data", user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._drop("chat_data", chat_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        self._refresh("user_data", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        self._refresh("chat_data", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # каждая запись уже зафиксирована (autocommit); закрываем базу при остановке
+        self._conn.close()
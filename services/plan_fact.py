@@ -0,0 +1,34 @@
+# services/plan_fact.py — план/факт для листа «Планы» по кэшу листа «Финансы»
+
+from typing import Dict, Optional, Tuple
+
+
+def _class_key(cls: str) -> str:
+    """Классификации сравниваем как SUMIFS в Google: без учёта регистра."""
+    return (cls or "").strip().casefold()
+
+
+class PlanFact:
+    """
+    Факт по (год, месяц, классификация) из помесячного куба Ledger.rollup
+    и остаток плана = факт − план (то же, что считала формула
+    SUMIFS(Финансы!F; G=классификация; B=месяц; A=год) − F в колонке «Остаток»).
+    Суммы месяца достаются из куба один раз на экземпляр.
+    """
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self._months: Dict[Tuple[int, int], Dict[str, float]] = {}
+
+    def fact(self, year: int, month: int, cls: str) -> float:
+        sums = self._months.get((year, month))
+        if sums is None:
+            sums = {}
+            for name, amount in self.ledger.rollup.range((year, month), (year, month)).items():
+                key = _class_key(name)
+                sums[key] = sums.get(key, 0.0) + amount
+            self._months[(year, month)] = sums
+        return sums.get(_class_key(cls), 0.0)
+
+    def remainder(self, year: int, month: int, cls: str, plan: Optional[float]) -> float:
+        return round(self.fact(year, month, cls) - (plan or 0.0), 2)
@@ -0,0 +1,154 @@
+# services/plans_cache.py — кэш листа «Планы» и готовых экранов «Планы на месяц»
+
+import os
+import sys
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from services import metrics
+from services.change_detect import change_detector
+from services.ledger_cache import ledger_cache
+from services.sheets_gateway import open_worksheets, row_lock, sheets_call
+from utils.parsing import cell_amount, cell_date, parse_year
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд перечитываем «Планы» (подхватываем ручные правки в таблице)
+TTL = float(os.getenv("PLANS_CACHE_TTL", "300"))
+# Общий бюджет памяти на все таблицы, байт
+MAX_BYTES = int(os.getenv("PLANS_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Чтение без форматирования — параметры Sheets API для values_batch_get
+_TYPED_PARAMS = {"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "SERIAL_NUMBER"}
+
+
+def parse_plan_rows(values: List[list]) -> List[list]:
+    """
+    Строки листа «Планы» (без шапки), прочитанные без форматирования:
+    [4] Дата — date или None, [5] Сумма и [6] Остаток — float или None,
+    остальные колонки — текст.
+    """
+    rows = []
+    for r in values:
+        r = list(r) + [""] * (9 - len(r))
+        r[4] = cell_date(r[4], parse_year(r[0]))
+        r[5] = cell_amount(r[5])
+        r[6] = cell_amount(r[6])
+        rows.append([v if i in (4, 5, 6) else ("" if v is None else str(v)) for i, v in enumerate(r)])
+    return rows
+
+
+class PlansEntry:
+    """
+    Прочитанный лист «Планы» одной таблицы.
+    screens — готовые тексты экрана: (год, месяц) → (версия Ledger, текст);
+    при перечитывании листа создаётся новый PlansEntry, и они сбрасываются сами.
+    nbytes — оценка занятой памяти (строки и тексты экранов).
+    """
+
+    def __init__(self, rows: List[list]):
+        self.rows = rows
+        self.loaded_at = time.monotonic()
+        self.screens: Dict[Tuple[int, int], Tuple[int, str]] = {}
+        self.nbytes = sum(sys.getsizeof(r) + sum(sys.getsizeof(v) for v in r) for r in rows)
+
+    def screen(self, year: int, month: int, version: int) -> Optional[str]:
+        cached = self.screens.get((year, month))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        return None
+
+    def store_screen(self, year: int, month: int, version: int, text: str) -> None:
+        old = self.screens.get((year, month))
+        if old is not None:
+            self.nbytes -= sys.getsizeof(old[1])
+        self.screens[(year, month)] = (version, text)
+        self.nbytes += sys.getsizeof(text)
+
+
+class PlansCache:
+    """
+    Кэш «Планов» по URL таблицы с TTL и общим бюджетом памяти (как ledger_cache:
+    при превышении вытесняются таблицы, к которым дольше всего не обращались).
+    Сбрасывается записями самого бота (новый план, перенос планов). Если при
+    промахе «Финансы» тоже не в кэше — оба листа читаются одним values_batch_get,
+    и Ledger кладётся в ledger_cache.
+    Все методы вызываются из цикла событий бота.
+    """
+
+    def __init__(self, ttl: float = TTL, max_bytes: int = MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, PlansEntry]" = OrderedDict()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(e.nbytes for e in self._entries.values())
+
+    async def get(self, url: str) -> PlansEntry:
+        if url in self._entries:
+            # таблицу правили вручную — детектор сбросит кэш через подписку
+            await change_detector.check(url)
+        entry = self._entries.get(url)
+        if entry is not None and time.monotonic() - entry.loaded_at <= self.ttl:
+            metrics.incr("plans_cache.hit")
+            self._entries.move_to_end(url)
+            return entry
+
+        metrics.incr("plans_cache.miss")
+        if ledger_cache.peek(url) is None:
+            # «Финансы» читаем заодно — тогда под замком номеров строк, как в ledger_cache.get
+            async with row_lock(url):
+                plans_values = await self._read(url, with_ledger=ledger_cache.peek(url) is None)
+        else:
+            plans_values = await self._read(url, with_ledger=False)
+
+        entry = self._entries[url] = PlansEntry(parse_plan_rows(plans_values[1:]))
+        self._entries.move_to_end(url)
+        self._evict(keep=url)
+        return entry
+
+    def peek(self, url: str) -> Optional[PlansEntry]:
+        """«Планы» из памяти, если они есть и не устарели; без обращения к таблице."""
+        entry = self._entries.get(url)
+        if entry is not None and time.monotonic() - entry.loaded_at <= self.ttl:
+            return entry
+        return None
+
+    async def _read(self, url: str, with_ledger: bool) -> List[list]:
+        """Лист «Планы» одним values_batch_get; with_ledger — и «Финансы» в кэш ledger_cache."""
+        ws_fin, ws_plans = await open_worksheets(url)
+        ranges = [f"'{ws_plans.title}'"]
+        if with_ledger:
+            ranges.append(f"'{ws_fin.title}'")
+        resp = await sheets_call(url, ws_plans.spreadsheet.values_batch_get, ranges, params=_TYPED_PARAMS)
+        value_ranges = resp.get("valueRanges", [])
+        if with_ledger and len(value_ranges) > 1:
+            await ledger_cache.load(url, value_ranges[1].get("values", []))
+        return value_ranges[0].get("values", []) if value_ranges else []
+
+    def _evict(self, keep: str = None) -> None:
+        total = self.nbytes
+        while total > self.max_bytes and len(self._entries) > 1:
+            url, entry = next(iter(self._entries.items()))
+            if url == keep:
+                self._entries.move_to_end(url)
+                continue
+            del self._entries[url]
+            total -= entry.nbytes
+            metrics.incr("plans_cache.evicted")
+            logger.info("plans_cache: вытеснена таблица %s (%d байт)", url, entry.nbytes)
+
+    def invalidate(self, url: str = None) -> None:
+        """Сбросить кэш таблицы (или весь кэш) — после записи в «Планы»."""
+        if url is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(url, None)
+
+
+# Общий экземпляр на процесс
+plans_cache = PlansCache()
+change_detector.subscribe(plans_cache.invalidate)
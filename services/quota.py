@@ -0,0 +1,151 @@
+# services/quota.py — учёт квот Google Sheets API: token bucket, приоритеты и повторы при 429/5xx
+
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+from typing import Optional
+
+from services import metrics
+
+# Квоты сервисного аккаунта (Google: по умолчанию 60 чтений и 60 записей в минуту на пользователя)
+READ_PER_MIN  = float(os.getenv("SHEETS_READ_PER_MIN", "60"))
+WRITE_PER_MIN = float(os.getenv("SHEETS_WRITE_PER_MIN", "60"))
+# Доля квоты на одну таблицу (чтения и записи вместе), чтобы одна таблица не выбирала всё
+SHEET_PER_MIN = float(os.getenv("SHEETS_SHEET_PER_MIN", "30"))
+# Повторы при 429/5xx: экспоненциальная задержка с «полным джиттером»
+MAX_RETRIES   = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+BACKOFF_BASE  = float(os.getenv("SHEETS_BACKOFF_BASE", "1.0"))
+BACKOFF_CAP   = float(os.getenv("SHEETS_BACKOFF_CAP", "32.0"))
+
+# Приоритеты: меньше — важнее
+INTERACTIVE = 0   # обработчики кнопок: пользователь ждёт ответа
+BACKGROUND  = 1   # очередь записи, сверка остатков, профилактика
+
+READ, WRITE = "read", "write"
+
+# Вызовы, которые меняют таблицу; всё остальное считаем чтением
+WRITE_CALLS = {
+    "append_row", "append_rows", "update", "batch_update", "delete_rows",
+    "insert_row", "insert_rows", "sort", "sort_sheets", "format", "add_rows",
+    "write_row_ids", "provision_spreadsheet", "move_row",
+}
+
+# Сколько запросов к API отправляет один вызов (остальные — один запрос)
+CALL_COSTS = {
+    # открытие, удаление «Лист1», шапки, фильтры, форматы, ID, сортировка
+    "provision_spreadsheet": 30,
+    # open_by_url + worksheets() + проверка фильтра «Финансов»
+    "get_worksheets":        3,
+    # (метаданные фильтра + ) скрытие колонки + запись ID
+    "write_row_ids":         3,
+}
+# Многозапросные записи, которые безопасно повторить целиком
+IDEMPOTENT_CALLS = {"write_row_ids"}
+
+_SEQ = itertools.count()
+
+
+def kind_of(fn) -> str:
+    """Чтение или запись — по имени вызываемой функции/метода gspread."""
+    return WRITE if getattr(fn, "__name__", "") in WRITE_CALLS else READ
+
+
+def cost_of(fn) -> int:
+    """Сколько токенов квоты берёт вызов fn — по числу запросов, которые он отправляет."""
+    return CALL_COSTS.get(getattr(fn, "__name__", ""), 1)
+
+
+class TokenBucket:
+    """
+    Token bucket на per_minute запросов в минуту. Ожидающие обслуживаются
+    по приоритету, при равном — по очереди.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._waiters: list = []
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self, priority: int = INTERACTIVE, cost: int = 1) -> None:
+        """Забрать cost токенов; если их нет — ждать своей очереди."""
+        # дороже ёмкости ведра не бывает — иначе вызов не дождался бы никогда
+        cost = min(cost, self.capacity)
+        self._refill()
+        if not self._waiters and self.tokens >= cost:
+            self.tokens -= cost
+            return
+
+        metrics.incr("quota.waited")
+        entry = [priority, next(_SEQ)]
+        heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                self._refill()
+                if self._waiters[0] is entry and self.tokens >= cost:
+                    heapq.heappop(self._waiters)
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.rate if self.tokens < cost else 0
+                await asyncio.sleep(max(wait, 0.01))
+        finally:
+            # отмена ожидания — убираем себя из очереди
+            if any(w is entry for w in self._waiters):
+                self._waiters = [w for w in self._waiters if w is not entry]
+                heapq.heapify(self._waiters)
+
+
+class QuotaScheduler:
+    """
+    Общие квоты процесса (один сервисный аккаунт): отдельные bucket-ы на чтение
+    и запись плюс по bucket-у на каждую таблицу.
+    """
+
+    def __init__(self):
+        self.buckets = {READ: TokenBucket(READ_PER_MIN), WRITE: TokenBucket(WRITE_PER_MIN)}
+        self._sheets: dict = {}
+
+    async def acquire(self, url: str, kind: str, priority: int = INTERACTIVE, cost: int = 1) -> None:
+        sheet = self._sheets.get(url)
+        if sheet is None:
+            sheet = self._sheets[url] = TokenBucket(SHEET_PER_MIN)
+        await sheet.take(priority, cost)
+        await self.buckets[kind].take(priority, cost)
+
+
+def status_of(exc: Exception) -> Optional[int]:
+    """HTTP-код ответа из APIError gspread / HTTPError requests."""
+    return getattr(getattr(exc, "response", None), "status_code", None)
+
+
+def retry_delay(exc: Exception, kind: str, attempt: int, fn=None) -> Optional[float]:
+    """
+    Через сколько секунд повторить запрос (None — не повторять).
+    429 повторяем всегда: запрос отклонён и не выполнен.
+    5xx — только для чтений: запись могла успеть примениться (повторная вставка строки).
+    Запись из нескольких запросов (cost_of > 1) не повторяем вовсе: 429 мог прийти
+    на середине, и повтор заново выполнил бы уже применённые шаги
+    (кроме IDEMPOTENT_CALLS).
+    """
+    if attempt >= MAX_RETRIES:
+        return None
+    name = getattr(fn, "__name__", "")
+    if kind == WRITE and cost_of(fn) > 1 and name not in IDEMPOTENT_CALLS:
+        return None
+    code = status_of(exc)
+    if code == 429 or (kind == READ and code is not None and 500 <= code < 600):
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    return None
+
+
+# Общий планировщик на процесс
+scheduler = QuotaScheduler()
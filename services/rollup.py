@@ -0,0 +1,98 @@
+# services/rollup.py — помесячные суммы по классификациям для экрана «Классификация»
+
+from bisect import bisect_left, bisect_right
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from services.balances import _cents
+
+# Месяц как (год, номер месяца 1–12)
+Month = Tuple[int, int]
+
+
+def month_index(year: int, month: int) -> int:
+    """Сквозной номер месяца: соседние месяцы отличаются на 1."""
+    return year * 12 + month - 1
+
+
+def month_of(index: int) -> Month:
+    return index // 12, index % 12 + 1
+
+
+class MonthlyRollup:
+    """
+    Куб (год, месяц, классификация) → сумма одной таблицы.
+    Строится вместе с Ledger и дальше меняется только на дельту каждой
+    добавленной/удалённой строки. Для ответа по диапазону месяцев держим
+    префиксные суммы по месяцам для каждой классификации: они пересобираются
+    лениво, при первом запросе после изменения.
+    Строки без распознанной даты или суммы в куб не попадают.
+    """
+
+    def __init__(self):
+        self._cells: Dict[str, Dict[int, list]] = {}  # классификация → {месяц: [копейки, строк]}
+        self._rows: Dict[int, int] = {}               # месяц → сколько в нём строк
+        self._prefix: Optional[Dict[str, tuple]] = None
+
+    def add(self, d: Optional[date], cls: str, amount: Optional[float]) -> None:
+        if d is None or amount is None:
+            return
+        m = month_index(d.year, d.month)
+        cell = self._cells.setdefault(cls, {}).setdefault(m, [0, 0])
+        cell[0] += _cents(amount)
+        cell[1] += 1
+        self._rows[m] = self._rows.get(m, 0) + 1
+        self._prefix = None
+
+    def remove(self, d: Optional[date], cls: str, amount: Optional[float]) -> None:
+        if d is None or amount is None:
+            return
+        m = month_index(d.year, d.month)
+        cells = self._cells.get(cls)
+        cell = cells.get(m) if cells else None
+        if cell is None:
+            return
+        cell[0] -= _cents(amount)
+        cell[1] -= 1
+        # у классификации не осталось строк в месяце — убираем ячейку
+        if cell[1] <= 0:
+            del cells[m]
+            if not cells:
+                del self._cells[cls]
+        self._rows[m] -= 1
+        if self._rows[m] <= 0:
+            del self._rows[m]
+        self._prefix = None
+
+    def _build_prefix(self) -> Dict[str, tuple]:
+        """классификация → (отсортированные месяцы, префиксные суммы с ведущим 0)."""
+        prefix = {}
+        for cls, cells in self._cells.items():
+            months = sorted(cells)
+            acc, sums = 0, [0]
+            for m in months:
+                acc += cells[m][0]
+                sums.append(acc)
+            prefix[cls] = (months, sums)
+        return prefix
+
+    def months(self) -> List[Month]:
+        """Месяцы, в которых есть строки, по возрастанию."""
+        return [month_of(m) for m in sorted(self._rows)]
+
+    def range(self, first: Optional[Month] = None, last: Optional[Month] = None) -> Dict[str, float]:
+        """
+        {классификация: сумма} за месяцы с first по last включительно
+        (None — без ограничения). Классификации без строк в диапазоне не попадают.
+        """
+        if self._prefix is None:
+            self._prefix = self._build_prefix()
+        lo = month_index(*first) if first else None
+        hi = month_index(*last) if last else None
+        result = {}
+        for cls, (months, sums) in self._prefix.items():
+            i = 0 if lo is None else bisect_left(months, lo)
+            j = len(months) if hi is None else bisect_right(months, hi)
+            if i < j:
+                result[cls] = (sums[j] - sums[i]) / 100
+        return result
@@ -0,0 +1,103 @@
+# services/sheets_gateway.py — неблокирующий доступ к Google Sheets из async-обработчиков
+
+import asyncio
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from services import metrics, quota
+from services.sheets_service import get_worksheets, cached_worksheets
+
+logger = logging.getLogger(__name__)
+
+# Сколько запросов к Sheets может выполняться одновременно (по всем таблицам)
+POOL_SIZE = int(os.getenv("SHEETS_POOL_SIZE", "8"))
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="sheets")
+
+# Замки по таблицам: запросы к одной таблице выполняются строго по очереди,
+# запросы к разным таблицам — параллельно в пределах пула
+_LOCKS: dict = {}
+
+# Замки «номеров строк» по таблицам: всё, что находит строку по номеру и пишет
+# в неё (правка/удаление по ID), и всё, что сдвигает строки (вставка, сортировка),
+# держит этот замок от поиска номера до обновления кэша — иначе между ними
+# другая запись сдвинет строки и правка попадёт в соседнюю операцию
+_ROW_LOCKS: dict = {}
+
+# Когда (time.monotonic()) бот последний раз успешно писал в таблицу — для services.change_detect
+last_write: dict = {}
+
+
+def _lock_for(url: str) -> asyncio.Lock:
+    lock = _LOCKS.get(url)
+    if lock is None:
+        lock = _LOCKS[url] = asyncio.Lock()
+    return lock
+
+
+def row_lock(url: str) -> asyncio.Lock:
+    """
+    Замок номеров строк таблицы url (см. _ROW_LOCKS). Внутри можно звать
+    sheets_call — это другой замок; вложенно row_lock не брать.
+    """
+    lock = _ROW_LOCKS.get(url)
+    if lock is None:
+        lock = _ROW_LOCKS[url] = asyncio.Lock()
+    return lock
+
+
+async def _call(url: str, priority: int, fn, args, kwargs):
+    kind = quota.kind_of(fn)
+    cost = quota.cost_of(fn)
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while True:
+        await quota.scheduler.acquire(url, kind, priority, cost)
+        try:
+            async with _lock_for(url):
+                result = await loop.run_in_executor(_EXECUTOR, functools.partial(fn, *args, **kwargs))
+            if kind == quota.WRITE:
+                last_write[url] = time.monotonic()
+            return result
+        except Exception as e:
+            delay = quota.retry_delay(e, kind, attempt, fn)
+            if delay is None:
+                raise
+            attempt += 1
+            metrics.incr("sheets.retry")
+            logger.warning(
+                "Sheets %s вернул %s, повтор %d через %.1fs",
+                getattr(fn, "__name__", fn), quota.status_of(e), attempt, delay,
+            )
+            await asyncio.sleep(delay)
+
+
+async def sheets_call(url: str, fn, *args, **kwargs):
+    """
+    Выполняет синхронный вызов gspread fn(*args, **kwargs) в пуле потоков,
+    не блокируя цикл событий бота. Вызовы к одной таблице (url) сериализуются.
+    Перед вызовом ждём квоту (services.quota), при 429/5xx — повторяем с задержкой.
+    """
+    return await _call(url, quota.INTERACTIVE, fn, args, kwargs)
+
+
+async def sheets_background_call(url: str, fn, *args, **kwargs):
+    """То же, что sheets_call, но с низким приоритетом: квоту первыми получают обработчики."""
+    return await _call(url, quota.BACKGROUND, fn, args, kwargs)
+
+
+async def open_worksheets(url: str):
+    """Асинхронная версия get_worksheets(): (Финансы, Планы)."""
+    # листы уже открыты — обращения к API не будет, квоту не тратим
+    cached = cached_worksheets(url)
+    if cached:
+        return cached
+    return await sheets_call(url, get_worksheets, url)
+
+
+def shutdown(wait: bool = True) -> None:
+    """Останавливает пул потоков (вызывается при завершении бота)."""
+    _EXECUTOR.shutdown(wait=wait)
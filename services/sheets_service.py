@@ -1,20 +1,85 @@
 # services/sheets_service.py — подключение и первичная настройка Google Sheets
 
-import os
-from gspread import service_account
+import re
+import logging
+import threading
+from datetime import date, datetime
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from services.google_client import get_client
+from utils.parsing import SHEETS_EPOCH
 
-def open_finance_and_plans(url: str):
+logger = logging.getLogger(__name__)
+
+# Неформатированное чтение: числа — числами, даты — серийными номерами (дни от 30.12.1899).
+# Передаётся в get_all_values()/get_values() gspread.
+TYPED_READ = {
+    "value_render_option":     "UNFORMATTED_VALUE",
+    "date_time_render_option": "SERIAL_NUMBER",
+}
+
+# Кэш открытых листов: url → (Финансы, Планы).
+# Worksheet хранит в _properties sheetId и gridProperties (rowCount/columnCount),
+# поэтому повторные обращения не делают ни одного запроса к Google.
+_WORKSHEETS: dict = {}
+_WORKSHEETS_LOCK = threading.Lock()
+
+
+def cached_worksheets(url: str):
+    """Листы из кэша процесса или None — без обращений к API."""
+    with _WORKSHEETS_LOCK:
+        return _WORKSHEETS.get(url)
+
+
+def get_worksheets(url: str):
+    """
+    Дешёвое получение листов «Финансы» и «Планы» для обработчиков.
+    Первый вызов для url — открытие документа и чтение метаданных,
+    все следующие — из кэша процесса, без обращений к API.
+    Никакой настройки (фильтры, форматы, сортировки) здесь не делается —
+    это работа provision_spreadsheet(), которая вызывается только из /setup.
+    """
+    cached = cached_worksheets(url)
+    if cached:
+        return cached
+
+    doc = get_client().open_by_url(url)
+    by_title = {ws.title: ws for ws in doc.worksheets()}
+    if "Финансы" not in by_title or "Планы" not in by_title:
+        # Таблицу подключили в обход /setup (например, «Изменить таблицу») —
+        # один раз настраиваем её полностью, как раньше делал каждый вызов
+        return provision_spreadsheet(url)
+    pair = (by_title["Финансы"], by_title["Планы"])
+    try:
+        _ensure_filter_covers_ids(doc, pair[0])
+    except Exception as e:
+        logger.warning("sheets_service: не удалось расширить фильтр «Финансов» %s: %s", url, e)
+
+    with _WORKSHEETS_LOCK:
+        _WORKSHEETS[url] = pair
+    return pair
+
+
+def invalidate_worksheets(url: str = None) -> None:
+    """
+    Сбрасывает кэш листов (для одного url или целиком) —
+    например, после повторной настройки таблицы.
+    """
+    with _WORKSHEETS_LOCK:
+        if url is None:
+            _WORKSHEETS.clear()
+        else:
+            _WORKSHEETS.pop(url, None)
+
+
+def provision_spreadsheet(url: str):
     """
     Открывает документ по URL, настраивает листы и возвращает объекты worksheets.
     Не затирает существующие данные, вставляет шапки при создании,
     фиксирует шапку и ставит фильтр на весь лист.
+    Вызывается один раз при подключении таблицы (/setup);
+    обработчики кнопок пользуются get_worksheets().
     """
-    creds = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-    sa = service_account(filename=creds)
-    doc = sa.open_by_url(url)
+    doc = get_client().open_by_url(url)
 
     # 1. Удаляем только лист по умолчанию «Лист1» или «Sheet1»
     for default_title in ("Лист1", "Sheet1"):
@@ -25,14 +90,14 @@ def open_finance_and_plans(url: str):
             pass
 
     # Заголовки для листов
-    finance_headers = ["Год", "Месяц", "Банк", "Операция", "Дата", "Сумма", "Классификация", "Конкретика"]
+    finance_headers = ["Год", "Месяц", "Банк", "Операция", "Дата", "Сумма", "Классификация", "Конкретика", "ID"]
     plans_headers   = ["Год", "Месяц", "Банк", "Операция", "Дата", "Сумма", "Остаток", "Классификация", "Конкретика"]
 
     # 2. Получаем или создаём лист 'Финансы' (не очищаем существующие данные)
     try:
         finance_ws = doc.worksheet("Финансы")
     except Exception:
-        finance_ws = doc.add_worksheet("Финансы", rows="1000", cols="8")
+        finance_ws = doc.add_worksheet("Финансы", rows="1000", cols="9")
         finance_ws.insert_row(finance_headers, 1)
 
     # 3. Получаем или создаём лист 'Планы' (не очищаем существующие данные)
@@ -54,8 +119,13 @@ def open_finance_and_plans(url: str):
     except Exception:
         pass
 
+    # Скрытая колонка I с ID строк (для старых листов — добавляем);
+    # ID существующих строк допишет кэш листа при первом чтении
+    write_row_ids(finance_ws, [])
+
     # —————— Автодополнение строк и расширение фильтра ——————
-    _ensure_capacity_and_filter(finance_ws, min_remaining=20, add_rows=500, max_col='H')
+    # у «Финансов» фильтр захватывает и колонку I: при сортировке из фильтра ID едут вместе со строкой
+    _ensure_capacity_and_filter(finance_ws, min_remaining=20, add_rows=500, max_col='I')
     _ensure_capacity_and_filter(plans_ws,   min_remaining=20, add_rows=500, max_col='I')
     
     # —————— Новая часть: выравнивание колонок ——————
@@ -130,8 +200,8 @@ def open_finance_and_plans(url: str):
         }]
         ws.spreadsheet.batch_update({"requests": requests})
 
-    # ─── сортировка по дате (E) по убыванию ───
-    for ws in (finance_ws, plans_ws):
+    # ─── сортировка по дате (E): «Финансы» — по убыванию, «Планы» — по возрастанию (как sort_sheets) ───
+    for ws, order in ((finance_ws, "DESCENDING"), (plans_ws, "ASCENDING")):
         sheet_id = ws._properties["sheetId"]
         sort_request = {
             "requests": [{
@@ -145,13 +215,17 @@ def open_finance_and_plans(url: str):
                     },
                     "sortSpecs": [{
                         "dimensionIndex": 4,           # колонка E (0‑based)
-                        "sortOrder":      "DESCENDING" # от новых к старым
+                        "sortOrder":      order
                     }]
                 }
             }]
         }
         ws.spreadsheet.batch_update(sort_request)
 
+    # Кладём настроенные листы в кэш, чтобы первое нажатие кнопки не открывало документ заново
+    with _WORKSHEETS_LOCK:
+        _WORKSHEETS[url] = (finance_ws, plans_ws)
+
     # Возвращаем обработанные листы
     return finance_ws, plans_ws
 
@@ -179,3 +253,214 @@ def _ensure_capacity_and_filter(ws, min_remaining: int = 20, add_rows: int = 500
         ws.set_basic_filter(filter_range)
     except Exception:
         pass
+
+
+def _filter_widen_request(doc, ws):
+    """
+    Запрос setBasicFilter, который расширяет фильтр листа ws до колонки I
+    с сохранением условий и сортировки пользователя; None — расширять не нужно
+    (фильтра нет или он и так захватывает I). Один лёгкий запрос метаданных.
+    """
+    sheet_id = ws._properties["sheetId"]
+    meta = doc.fetch_sheet_metadata({"fields": "sheets(properties.sheetId,basicFilter)"})
+    for sheet in meta.get("sheets", []):
+        if sheet.get("properties", {}).get("sheetId") != sheet_id:
+            continue
+        current = sheet.get("basicFilter")
+        if current is None:
+            return None
+        rng = dict(current.get("range", {}))
+        # нет endColumnIndex — фильтр и так до последней колонки
+        if "endColumnIndex" not in rng or rng["endColumnIndex"] >= 9:
+            return None
+        rng["endColumnIndex"] = 9
+        new_filter = {"range": rng}
+        for key in ("sortSpecs", "filterSpecs"):
+            if key in current:
+                new_filter[key] = current[key]
+        if "filterSpecs" not in current and "criteria" in current:
+            new_filter["criteria"] = current["criteria"]
+        return {"setBasicFilter": {"filter": new_filter}}
+    return None
+
+
+def _ensure_filter_covers_ids(doc, ws) -> None:
+    """
+    Таблицы, настроенные раньше, имеют фильтр «Финансов» только на A:H:
+    сортировка из фильтра переставляет строки, а ID в колонке I остаются
+    на месте. Расширяем диапазон фильтра до I.
+    Если колонки I ещё нет (лист на 8 колонок), фильтр расширит
+    _ensure_id_column — тем же запросом, которым добавит колонку.
+    """
+    if ws.col_count < 9:
+        return
+    request = _filter_widen_request(doc, ws)
+    if request is not None:
+        doc.batch_update({"requests": [request]})
+        logger.info("sheets_service: фильтр «Финансов» расширен до колонки ID")
+
+
+def _ensure_id_column(ws) -> None:
+    """
+    Колонка I листа «Финансы»: шапка «ID», колонка скрыта от пользователя.
+    Если в листе всего 8 колонок — добавляем девятую и в том же batch_update
+    расширяем на неё фильтр.
+    """
+    sheet_id = ws._properties["sheetId"]
+    requests = []
+    if ws.col_count < 9:
+        requests.append({
+            "appendDimension": {"sheetId": sheet_id, "dimension": "COLUMNS", "length": 9 - ws.col_count}
+        })
+        widen = _filter_widen_request(ws.spreadsheet, ws)
+        if widen is not None:
+            requests.append(widen)
+    requests.append({
+        "updateDimensionProperties": {
+            "range": {"sheetId": sheet_id, "dimension": "COLUMNS", "startIndex": 8, "endIndex": 9},
+            "properties": {"hiddenByUser": True},
+            "fields": "hiddenByUser",
+        }
+    })
+    ws.spreadsheet.batch_update({"requests": requests})
+    if ws.col_count < 9:
+        ws._properties["gridProperties"]["columnCount"] = 9
+
+
+def write_row_ids(ws, ids: list) -> None:
+    """Записывает шапку «ID» и ID строк в колонку I одним запросом."""
+    _ensure_id_column(ws)
+    values = [["ID"]] + [[i] for i in ids]
+    ws.update(f"I1:I{len(values)}", values, value_input_option="RAW")
+
+
+# Дата, как её пишут обработчики: «05.06.2025»
+_RE_BOT_DATE = re.compile(r"^(\d{1,2})\.(\d{1,2})\.(\d{4})$")
+# ISO-дата (тариф 2, правка операции): «2025-06-05»
+_RE_ISO_DATE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})$")
+# Число текстом, как его пишут обработчики: «1000,00», «-250.5», «1 234,56», «2025»
+_RE_NUMBER = re.compile(r"^[+-]?(?:\d{1,3}(?:[ \xa0]\d{3})+|\d+)(?:[.,]\d+)?$")
+
+
+def _date_serial(d: date) -> int:
+    return (d - SHEETS_EPOCH).days
+
+
+def _cell_value(value) -> dict:
+    """
+    Значение ячейки для updateCells (userEnteredValue) с сохранением типа:
+    числа и числа текстом («1000,00», «2025») — numberValue, даты
+    («05.06.2025», «2025-06-05», date) — серийным номером, «=…» — формулой,
+    остальное — текстом (как разобрал бы USER_ENTERED). Формат ячейки не трогаем:
+    он унаследован от соседней строки (дата в E, «#,##0.00» в F:G).
+    """
+    if value is None or value == "":
+        return {}
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, (int, float)):
+        return {"numberValue": value}
+    if isinstance(value, datetime):
+        value = value.date()
+    if isinstance(value, date):
+        return {"numberValue": _date_serial(value)}
+    text = str(value)
+    if text.startswith("="):
+        return {"formulaValue": text}
+    stripped = text.strip()
+    if _RE_NUMBER.match(stripped):
+        return {"numberValue": float(stripped.replace(" ", "").replace("\xa0", "").replace(",", "."))}
+    m = _RE_BOT_DATE.match(stripped)
+    if m:
+        d, mo, y = m.group(1), m.group(2), m.group(3)
+    else:
+        m = _RE_ISO_DATE.match(stripped)
+        if m:
+            y, mo, d = m.group(1), m.group(2), m.group(3)
+    if m:
+        try:
+            return {"numberValue": _date_serial(date(int(y), int(mo), int(d)))}
+        except ValueError:
+            pass
+    return {"stringValue": text}
+
+
+def insert_rows(ws, placed: list) -> None:
+    """
+    Вставляет строки на заданные места листа одним batch_update — вместо
+    append_row + сортировки всего листа.
+    placed — [(номер_строки, значения), ...] в порядке применения: номер каждой
+    строки считается с учётом уже вставленных перед ней.
+    Для каждой строки: insertDimension (сдвигает нижние строки и наследует
+    форматы соседней строки) + updateCells с типизированными значениями
+    (см. _cell_value): суммы уходят числами, а не текстом в локали таблицы.
+    """
+    sheet_id = ws._properties["sheetId"]
+    requests = []
+    for row_number, values in placed:
+        start = row_number - 1  # 0-based индекс строки
+        requests.append({
+            "insertDimension": {
+                "range": {
+                    "sheetId":    sheet_id,
+                    "dimension":  "ROWS",
+                    "startIndex": start,
+                    "endIndex":   start + 1,
+                },
+                # под шапкой наследуем формат от строки ниже, иначе — от строки выше
+                "inheritFromBefore": start > 1,
+            }
+        })
+        requests.append({
+            "updateCells": {
+                "start":  {"sheetId": sheet_id, "rowIndex": start, "columnIndex": 0},
+                "rows":   [{"values": [{"userEnteredValue": _cell_value(v)} for v in values]}],
+                "fields": "userEnteredValue",
+            }
+        })
+    if requests:
+        ws.spreadsheet.batch_update({"requests": requests})
+
+
+def move_row(ws, from_row: int, to_row: int) -> None:
+    """
+    Переносит строку from_row так, чтобы после переноса она стала строкой to_row
+    (номера 1-based, как на листе) — одним moveDimension.
+    """
+    start, final = from_row - 1, to_row - 1
+    # destinationIndex считается в координатах до переноса
+    dest = final + 1 if final > start else final
+    ws.spreadsheet.batch_update({"requests": [{
+        "moveDimension": {
+            "source": {
+                "sheetId":    ws._properties["sheetId"],
+                "dimension":  "ROWS",
+                "startIndex": start,
+                "endIndex":   start + 1,
+            },
+            "destinationIndex": dest,
+        }
+    }]})
+
+
+def sort_sheets(url: str) -> None:
+    """
+    Полная сортировка листов по дате (E): «Финансы» — по убыванию, «Планы» — по возрастанию.
+    Обработчики вставляют строки сразу на своё место, поэтому это
+    редкая профилактика (ручные правки в таблице и т.п.), а не шаг каждой записи.
+    """
+    finance_ws, plans_ws = get_worksheets(url)
+    requests = []
+    for ws, order in ((finance_ws, "DESCENDING"), (plans_ws, "ASCENDING")):
+        requests.append({
+            "sortRange": {
+                "range": {
+                    "sheetId":          ws._properties["sheetId"],
+                    "startRowIndex":    1,            # пропускаем заголовок
+                    "startColumnIndex": 0,
+                    "endColumnIndex":   ws.col_count,
+                },
+                "sortSpecs": [{"dimensionIndex": 4, "sortOrder": order}],
+            }
+        })
+    finance_ws.spreadsheet.batch_update({"requests": requests})
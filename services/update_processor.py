@@ -0,0 +1,100 @@
+# services/update_processor.py — параллельная обработка апдейтов с сохранением порядка для каждого пользователя
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def update_owner(update: object) -> Optional[int]:
+    """Чей это апдейт: id пользователя, иначе id чата (None — служебный апдейт)."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+def _press_key(update: object, owner: int) -> Optional[tuple]:
+    """Ключ нажатия кнопки: (пользователь, сообщение, callback_data); None — не нажатие."""
+    if not isinstance(update, Update) or update.callback_query is None:
+        return None
+    q = update.callback_query
+    message_id = q.message.message_id if q.message is not None else q.inline_message_id
+    return owner, message_id, q.data
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    До max_concurrent_updates апдейтов обрабатываются одновременно, но апдейты
+    одного пользователя — строго по очереди, в порядке поступления:
+    пока один ждёт Sheets или OpenAI, остальные пользователи не стоят.
+    - замок пользователя удаляется, как только у него не осталось апдейтов
+      в работе или в очереди, — карта замков не растёт с числом пользователей;
+    - повторное нажатие той же кнопки того же сообщения, пока первое ещё
+      обрабатывается (двойной тап по «✅»), отбрасывается: иначе вторая
+      обработка записала бы ту же строку ещё раз;
+    - сначала берём замок пользователя, и только потом — общий слот: апдейты
+      пользователя, ждущие своей очереди, не занимают слоты. Поэтому
+      process_update переопределён (базовый берёт слот до do_process_update).
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._pending: Dict[int, int] = {}   # сколько апдейтов пользователя в работе/очереди
+        self._presses: set = set()           # нажатия, которые сейчас обрабатываются
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        owner = update_owner(update)
+        if owner is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        press = _press_key(update, owner)
+        if press is not None:
+            if press in self._presses:
+                metrics.incr("updates.duplicate_press")
+                coroutine.close()
+                try:
+                    await update.callback_query.answer()
+                except Exception as e:
+                    logger.debug("update_processor: не удалось ответить на повторное нажатие: %s", e)
+                return
+            self._presses.add(press)
+
+        lock = self._locks.get(owner)
+        if lock is None:
+            lock = self._locks[owner] = asyncio.Lock()
+        self._pending[owner] = self._pending.get(owner, 0) + 1
+        try:
+            async with lock:
+                async with self._slots:
+                    await coroutine
+        finally:
+            self._pending[owner] -= 1
+            if self._pending[owner] == 0:
+                del self._pending[owner]
+                del self._locks[owner]
+            if press is not None:
+                self._presses.discard(press)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # не вызывается: порядок замков задаёт process_update
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,104 @@
+# services/write_queue.py — отложенная пакетная запись новых строк в лист «Финансы»
+
+import os
+import asyncio
+import logging
+from typing import Dict, List
+
+from services import metrics
+from services.ledger_cache import ledger_cache
+from services.sheets_gateway import open_worksheets, row_lock, sheets_background_call
+from services.sheets_service import insert_rows
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд копим строки одной таблицы перед записью одним запросом
+FLUSH_WINDOW = float(os.getenv("SHEETS_FLUSH_WINDOW", "0.5"))
+
+
+class _Pending:
+    """Строки одного обращения и куда сообщить, если запись не удалась."""
+
+    def __init__(self, rows: List[list], bot=None, chat_id=None):
+        self.rows = rows
+        self.bot = bot
+        self.chat_id = chat_id
+
+
+class WriteQueue:
+    """
+    Очередь записи по таблицам. Обработчик кладёт строки и сразу отвечает
+    пользователю; через FLUSH_WINDOW все накопленные строки таблицы уходят
+    одним batch_update (insert_rows — каждая на своё место по дате).
+    Если запись не удалась — пишем об этом в чат каждому, чьи строки были в пакете.
+    Все методы вызываются из цикла событий бота.
+    """
+
+    def __init__(self, window: float = FLUSH_WINDOW):
+        self.window = window
+        self._pending: Dict[str, List[_Pending]] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+
+    def submit(self, url: str, rows: List[list], bot=None, chat_id=None) -> None:
+        """Поставить строки (уже с ID) в очередь записи таблицы url."""
+        self._pending.setdefault(url, []).append(_Pending(rows, bot, chat_id))
+        metrics.incr("write_queue.rows", len(rows))
+        if url not in self._timers:
+            self._timers[url] = asyncio.create_task(self._flush_later(url))
+
+    async def _flush_later(self, url: str) -> None:
+        await asyncio.sleep(self.window)
+        self._timers.pop(url, None)
+        await self.flush(url)
+
+    async def flush(self, url: str) -> None:
+        """Записать всё накопленное для url одним запросом."""
+        batch = self._pending.pop(url, [])
+        if not batch:
+            return
+        rows = [r for p in batch for r in p.rows]
+        # места вставки, запись и обновление кэша — под замком номеров строк,
+        # чтобы правка/удаление по номеру строки не вклинились между ними
+        async with row_lock(url):
+            try:
+                ws, _ = await open_worksheets(url)
+                ledger = await ledger_cache.get(url, locked=True)
+                placed = ledger.insertion_points(rows)
+                await sheets_background_call(url, insert_rows, ws, placed)
+            except Exception as e:
+                metrics.incr("write_queue.failed", len(rows))
+                logger.error("write_queue: не удалось записать %d строк в %s: %s", len(rows), url, e)
+                # кэш мог разойтись с листом — перечитаем при следующем обращении
+                ledger_cache.invalidate(url)
+                failed = True
+            else:
+                ledger_cache.insert(url, placed)
+                failed = False
+        if failed:
+            await self._report_failure(batch)
+            return
+        metrics.incr("write_queue.flushes")
+
+    async def _report_failure(self, batch: List[_Pending]) -> None:
+        for p in batch:
+            if p.bot is None or p.chat_id is None:
+                continue
+            try:
+                await p.bot.send_message(
+                    chat_id=p.chat_id,
+                    text=f"⚠️ Не удалось записать в таблицу {len(p.rows)} строк(и). Попробуйте добавить ещё раз.",
+                )
+            except Exception as e:
+                logger.warning("write_queue: не удалось сообщить об ошибке в чат %s: %s", p.chat_id, e)
+
+    async def flush_all(self) -> None:
+        """Записать всё, не дожидаясь окна (при остановке бота)."""
+        for task in self._timers.values():
+            task.cancel()
+        self._timers.clear()
+        for url in list(self._pending):
+            await self.flush(url)
+
+
+# Общий экземпляр на процесс
+write_queue = WriteQueue()
@@ -0,0 +1,41 @@
+# tests/test_cache_key.py — ключ кэша разбора тарифа 2: контекст даты
+
+from datetime import date
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("openai")
+
+from handlers.tariff2_text_voice import _cache_key  # noqa: E402
+
+TODAY = date(2025, 6, 5)
+
+
+@pytest.mark.parametrize("text", [
+    "кофе 250 5 января",
+    "кофе 250 в феврале",
+    "кофе 250 8 марта",
+    "кофе 250 в апреле",
+    "кофе 250 1 мая",
+    "кофе 250 в мае",
+    "кофе 250 в июне",
+    "кофе 250 в июле",
+    "кофе 250 в августе",
+    "кофе 250 в сентябре",
+    "кофе 250 в октябре",
+    "кофе 250 в ноябре",
+    "кофе 250 в декабре",
+    "кофе 250 05.06",
+])
+def test_explicit_date_keys_on_year(text):
+    assert _cache_key(text, TODAY).startswith("2025|")
+
+
+@pytest.mark.parametrize("text", ["кофе 250", "кофе 250 вчера", "майонез 120"])
+def test_relative_date_keys_on_offset(text):
+    assert _cache_key(text, TODAY).startswith("rel|")
+
+
+def test_weekday_keys_on_today():
+    assert _cache_key("кофе 250 в пятницу", TODAY).startswith("2025-06-05|")
@@ -0,0 +1,32 @@
+# tests/test_cell_value.py — типы значений, которые insert_rows пишет в лист
+
+from datetime import date
+
+import pytest
+
+pytest.importorskip("gspread")
+
+from services.sheets_service import _cell_value  # noqa: E402
+
+# 05.06.2025 — серийный номер Google Sheets
+SERIAL = (date(2025, 6, 5) - date(1899, 12, 30)).days
+
+
+@pytest.mark.parametrize("value, expected", [
+    (-250.5,        {"numberValue": -250.5}),
+    (2025,          {"numberValue": 2025}),
+    ("2025",        {"numberValue": 2025.0}),       # Год плана: str(dt.year)
+    ("1000,00",     {"numberValue": 1000.0}),       # стартовый остаток банка
+    ("-1 234,56",   {"numberValue": -1234.56}),
+    ("05.06.2025",  {"numberValue": SERIAL}),
+    ("2025-06-05",  {"numberValue": SERIAL}),       # дата тарифа 2
+    (date(2025, 6, 5), {"numberValue": SERIAL}),
+    ("=A1*2",       {"formulaValue": "=A1*2"}),
+    ("Июнь",        {"stringValue": "Июнь"}),
+    ("r1a2b3c4d5e", {"stringValue": "r1a2b3c4d5e"}),
+    ("31.02.2025",  {"stringValue": "31.02.2025"}),
+    ("",            {}),
+    (None,          {}),
+])
+def test_cell_value(value, expected):
+    assert _cell_value(value) == expected
@@ -0,0 +1,49 @@
+# tests/test_classifier.py — подсказка «Классификации» по истории пользователя
+
+import pytest
+
+from services.classifier import CategoryModel
+
+# Полтора десятка классов, как в обычной таблице
+CLASSES = [
+    "Кафе", "Такси", "Продукты", "Аптека", "Связь", "Одежда", "Кино", "Спорт",
+    "Книги", "Подарки", "Ремонт", "Бензин", "Жильё", "Кредит", "Животные", "Красота",
+]
+
+
+@pytest.fixture
+def model():
+    m = CategoryModel()
+    for cls in CLASSES:
+        for i in range(30):
+            m.add(f"{cls} покупка номер{i % 5}", cls)
+    for _ in range(20):
+        m.add("Шоколадница", "Кафе")
+    m.add("до дома", "Такси")
+    m.add("до офиса", "Такси")
+    m.add("обед до работы", "Кафе")
+    return m
+
+
+def test_word_seen_with_one_class(model):
+    cls, confidence = model.predict("шоколадница")
+    assert cls == "Кафе" and confidence > 0.9
+
+
+def test_strong_word_outweighs_common_one(model):
+    assert model.predict("Шоколадница до центра")[0] == "Кафе"
+
+
+@pytest.mark.parametrize("text", [
+    "до центра",      # слово встречалось с двумя классами
+    "покупка",        # со всеми классами поровну
+    "новое слово",    # ни с одним
+])
+def test_no_confident_guess(model, text):
+    assert model.predict(text) is None
+
+
+def test_remove_forgets_row(model):
+    for _ in range(20):
+        model.remove("Шоколадница", "Кафе")
+    assert model.predict("шоколадница") is None
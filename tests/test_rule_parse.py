@@ -0,0 +1,65 @@
+# tests/test_rule_parse.py — разбор типовых сообщений тарифа 2 без модели
+
+from datetime import date
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("openai")
+
+from handlers.tariff2_text_voice import rule_parse  # noqa: E402
+
+TODAY = date(2025, 6, 5)
+
+ONE_BANK = {
+    "banks":     {"сбер": "Сбер"},
+    "classes":   {"кафе": "Кафе", "такси": "Такси"},
+    "specifics": {"кофе": "Кафе"},
+    "model":     None,
+}
+TWO_BANKS = dict(ONE_BANK, banks={"сбер": "Сбер", "тинькофф": "Тинькофф"})
+
+
+@pytest.mark.parametrize("text", [
+    "кофе 250 300",
+    "кофе 100 200 сбер",
+    "кофе 250 400 500",
+    "кофе 250р 300",
+    "кофе 250 в пятницу",
+    "кофе 5 июня 250",
+    "кафе 250 в мае",
+    "кафе 250 завтра",
+    "кафе 250 на прошлой неделе",
+    "кафе 250 3 дня назад",
+    "кафе 250 в прошлом месяце",
+])
+def test_ambiguous_goes_to_model(text):
+    assert rule_parse(text, ONE_BANK, TODAY) is None
+
+
+@pytest.mark.parametrize("text, amount", [
+    ("кофе 250", 250),
+    ("такси 1 200", 1200),
+    ("кофе 1 200 000", 1200000),
+    ("такси 100 000", 100000),
+])
+def test_amount(text, amount):
+    ops = rule_parse(text, ONE_BANK, TODAY)
+    assert ops and abs(ops[0]["Сумма"]) == amount
+
+
+def test_relative_day():
+    ops = rule_parse("кафе 250 вчера", ONE_BANK, TODAY)
+    assert ops and ops[0]["Дата"] == "2025-06-04"
+
+
+def test_date_and_amount_are_not_joined():
+    ops = rule_parse("кофе 05.06 250", ONE_BANK, TODAY)
+    assert ops and abs(ops[0]["Сумма"]) == 250
+    assert ops[0]["Дата"] == "2025-06-05"
+
+
+def test_missing_bank_with_several_banks():
+    assert rule_parse("кофе 250", TWO_BANKS, TODAY) is None
+    ops = rule_parse("кофе 250 тинькофф", TWO_BANKS, TODAY)
+    assert ops and ops[0]["Банк"] == "Тинькофф"
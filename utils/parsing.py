@@ -0,0 +1,194 @@
+# utils/parsing.py — разбор значений ячеек листов «Финансы» и «Планы»
+
+import re
+import time
+from datetime import datetime, date, timedelta
+from functools import lru_cache
+from typing import Optional
+
+# Карта родительного падежа месяцев на номер
+GENITIVE_MONTHS = {
+    "января":   1, "февраля":  2, "марта":    3, "апреля": 4,
+    "мая":      5, "июня":     6, "июля":     7, "августа":8,
+    "сентября": 9, "октября": 10, "ноября":  11, "декабря":12,
+}
+
+# Родительный падеж по номеру месяца и короткие дни недели — для показа дат «как в листе»
+MONTHS_GENITIVE = {n: name for name, n in GENITIVE_MONTHS.items()}
+WEEKDAYS_SHORT = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+
+# Нулевой день серийных дат Google Sheets (SERIAL_NUMBER)
+SHEETS_EPOCH = date(1899, 12, 30)
+
+
+# Предкомпилированные шаблоны форматов даты
+_RE_DMY = re.compile(r"(\d{2})\.(\d{2})\.(\d{4})")
+_RE_ISO = re.compile(r"(\d{4})-(\d{2})-(\d{2})")
+_RE_MDY = re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})")
+_RE_RU  = re.compile(r"(\d{1,2})\s+([А-Яа-яЁё]+)(?:,.*)?")
+
+# Сколько разных строк-дат помним (в ledger даты сильно повторяются)
+DATE_CACHE_SIZE = 8192
+
+
+def _parse_date(s: str, year: int) -> Optional[date]:
+    """
+    Разбор одной уже обрезанной строки. Формат определяем по первым символам,
+    чтобы пробовать один шаблон, а не все подряд.
+    """
+    try:
+        if len(s) == 10 and s[2] == "." and s[5] == ".":
+            # DD.MM.YYYY
+            m = _RE_DMY.fullmatch(s)
+            if m:
+                return date(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+        elif len(s) >= 10 and s[4] == "-":
+            # YYYY-MM-DD (и ISO с временем)
+            m = _RE_ISO.fullmatch(s)
+            if m:
+                return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            return datetime.fromisoformat(s).date()
+        elif "/" in s:
+            # MM/DD/YYYY
+            m = _RE_MDY.fullmatch(s)
+            if m:
+                return date(int(m.group(3)), int(m.group(1)), int(m.group(2)))
+        elif s[:1].isdigit():
+            # Русский формат «13 июля, вс» или «13 июля»
+            m = _RE_RU.fullmatch(s)
+            if m:
+                month = GENITIVE_MONTHS.get(m.group(2).lower())
+                if month:
+                    return date(year, month, int(m.group(1)))
+    except ValueError:
+        # 31.02.2025 и т.п.
+        return None
+    return None
+
+
+_parse_date_cached = lru_cache(maxsize=DATE_CACHE_SIZE)(_parse_date)
+
+
+def parse_sheet_date(s: str, year_hint: Optional[int] = None) -> Optional[date]:
+    """
+    Пробуем распарсить строку даты из Google Sheets:
+      - DD.MM.YYYY
+      - YYYY-MM-DD
+      - MM/DD/YYYY
+      - «DD месяц, ...» (русский родительный падеж, без года → year_hint или текущий год)
+    Результат запоминается по (строка, год) — повторяющиеся даты не разбираются заново.
+    """
+    if type(s) is not str:
+        s = str(s)
+    s = s.strip()
+    if not s:
+        return None
+    return _parse_date_cached(s, year_hint or _current_year())
+
+
+# Текущий год перепроверяем раз в минуту: date.today() дороже самого разбора из кэша
+_YEAR = {"value": 0, "until": 0.0}
+
+
+def _current_year() -> int:
+    now = time.time()
+    if now >= _YEAR["until"]:
+        _YEAR["value"] = date.today().year
+        _YEAR["until"] = now + 60
+    return _YEAR["value"]
+
+
+def parse_amount(raw) -> Optional[float]:
+    """
+    Приводим сумму из ячейки к числу: «1 234,56» → 1234.56.
+    Пустое или нечисловое значение → None.
+    """
+    if isinstance(raw, (int, float)):
+        return float(raw)
+    s = str(raw).replace("\xa0", "").replace(" ", "").replace(",", ".")
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+
+def parse_year(raw) -> Optional[int]:
+    """Значение колонки «Год» → int (или None)."""
+    try:
+        return int(str(raw).strip())
+    except ValueError:
+        return None
+
+
+# —————— типизированные значения (UNFORMATTED_VALUE + SERIAL_NUMBER) ——————
+
+def serial_to_date(serial: float) -> date:
+    """Серийный номер даты Google Sheets → date (дробная часть — время, отбрасываем)."""
+    return SHEETS_EPOCH + timedelta(days=int(serial))
+
+
+def cell_date(value, year_hint: Optional[int] = None) -> Optional[date]:
+    """
+    Дата из ячейки: серийный номер (неформатированное чтение) — напрямую,
+    строка (то, что записал бот, или текст в ячейке) — через parse_sheet_date.
+    """
+    if isinstance(value, date):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return serial_to_date(value)
+    if value is None or not str(value).strip():
+        return None
+    return parse_sheet_date(value, year_hint)
+
+
+def cell_amount(value) -> Optional[float]:
+    """Сумма из ячейки: число — как есть, строка — через parse_amount."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if value is None or not str(value).strip():
+        return None
+    return parse_amount(value)
+
+
+def format_sheet_date(d: date) -> str:
+    """Дата так, как её показывает лист (формат «d mmmm, ddd»): «7 июня, пт»."""
+    return f"{d.day} {MONTHS_GENITIVE[d.month]}, {WEEKDAYS_SHORT[d.weekday()]}"
+
+
+def format_amount(x: float) -> str:
+    """Сумма так, как её показывает лист (формат «#,##0.00»): «1 234,56»."""
+    return f"{x:,.2f}".replace(",", "\xa0").replace(".", ",")
+
+
+# —————— микро-бенчмарк: python -m utils.parsing ——————
+
+def _benchmark(rows: int = 100_000) -> None:
+    """Стоимость parse_sheet_date на строку для ledger из rows строк (~4 года дат)."""
+    import random
+
+    days = [date(2022, 1, 1) + timedelta(days=i) for i in range(4 * 365)]
+    fmts = [
+        lambda d: d.strftime("%d.%m.%Y"),
+        lambda d: d.isoformat(),
+        format_sheet_date,
+    ]
+    random.seed(1)
+    sample = [random.choice(fmts)(random.choice(days)) for _ in range(rows)]
+    year = date.today().year
+
+    def run(label, fn):
+        t0 = time.perf_counter()
+        for s in sample:
+            fn(s)
+        dt = time.perf_counter() - t0
+        print(f"{label:<28} {dt * 1000:8.1f} мс   {dt / rows * 1e6:6.2f} мкс/строка")
+
+    run("без кэша (_parse_date)", lambda s: _parse_date(s.strip(), year))
+    _parse_date_cached.cache_clear()
+    run("parse_sheet_date, холодный", parse_sheet_date)
+    run("parse_sheet_date, тёплый", parse_sheet_date)
+    print(_parse_date_cached.cache_info())
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -1,7 +1,122 @@
 # utils/state.py
 
+import os
+import time
+import logging
+import weakref
+from collections import OrderedDict
+
+from telegram.ext import ConversationHandler
+
 from utils.constants import STATE_IDLE
 
+logger = logging.getLogger(__name__)
+
+# Ключи user_data, которые переживают перезапуск (пишутся в persistence).
+# Всё остальное — черновики и кэши (pending_op, last_ops, user_banks, …): только в памяти
+DURABLE_KEYS = frozenset({"tariff", "sheet_url", "current_state", "state"})
+# Через сколько секунд без апдейтов от пользователя его черновики выбрасываются
+DRAFT_TTL = float(os.getenv("USER_DRAFT_TTL", "21600"))
+# Сколько пользователей одновременно могут держать черновики в памяти
+DRAFT_MAX_USERS = int(os.getenv("USER_DRAFT_MAX_USERS", "5000"))
+# Как часто просматривать черновики на истечение, секунд
+_SWEEP_EVERY = 60.0
+
+# UserState с черновиками, от давно неактивных к недавним
+_active: "OrderedDict[int, weakref.ref]" = OrderedDict()
+_last_sweep = 0.0
+
+
+class UserState(dict):
+    """
+    user_data одного пользователя (ContextTypes(user_data=UserState)).
+    Ключи DURABLE_KEYS — постоянные: только они попадают в persistence.
+    Остальные ключи — черновики: живут в памяти, пока пользователь активен,
+    и выбрасываются через DRAFT_TTL секунд без апдейтов или когда пользователей
+    с черновиками больше DRAFT_MAX_USERS (первыми — давно неактивные).
+    touch() вызывается persistence перед каждым апдейтом пользователя.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.touched_at = time.monotonic()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if key not in DURABLE_KEYS:
+            self.touch()
+
+    def touch(self) -> None:
+        now = time.monotonic()
+        self.touched_at = now
+        _active[id(self)] = weakref.ref(self)
+        _active.move_to_end(id(self))
+        if now - _last_sweep >= _SWEEP_EVERY or len(_active) > DRAFT_MAX_USERS:
+            _sweep(now)
+
+    def durable(self) -> dict:
+        """Только постоянные ключи — то, что сохраняется на диск."""
+        return {k: v for k, v in self.items() if k in DURABLE_KEYS}
+
+    def clear_drafts(self) -> None:
+        for key in [k for k in self if k not in DURABLE_KEYS]:
+            del self[key]
+
+
+def _sweep(now: float) -> None:
+    """Выбрасывает черновики пользователей с истёкшим TTL и сверх DRAFT_MAX_USERS."""
+    global _last_sweep
+    _last_sweep = now
+    while _active:
+        key, ref = next(iter(_active.items()))
+        state = ref()
+        if state is not None and now - state.touched_at < DRAFT_TTL and len(_active) <= DRAFT_MAX_USERS:
+            break
+        del _active[key]
+        if state is not None:
+            state.clear_drafts()
+
+
+async def _draft_expired(update, context) -> int:
+    """Черновик выброшен (долго не было апдейтов) — сообщаем и выходим в главное меню."""
+    # Локальный импорт, чтобы не было циклической зависимости на уровне модуля
+    from handlers.menu import show_main_menu
+
+    notice = "⌛ Черновик устарел — начните заново."
+    if update.callback_query:
+        try:
+            await update.callback_query.answer(notice)
+        except Exception as e:
+            logger.debug("_draft_expired: q.answer() skipped: %s", e)
+    elif update.message:
+        await update.message.reply_text(notice)
+    await show_main_menu(update, context)
+    return ConversationHandler.END
+
+
+def _guarded(callback, key: str):
+    async def guarded(update, context):
+        if key not in context.user_data:
+            return await _draft_expired(update, context)
+        return await callback(update, context)
+    guarded.__name__ = getattr(callback, "__name__", "guarded")
+    return guarded
+
+
+def guard_drafts(states: dict, key: str, skip=()) -> dict:
+    """
+    Для states ConversationHandler: обработчики, которые читают черновик key
+    (все, кроме skip — тех, что черновик создают или он им не нужен),
+    при выброшенном черновике завершают диалог вместо KeyError.
+    Возвращает тот же states.
+    """
+    for handlers in states.values():
+        for handler in handlers:
+            if handler.callback not in skip:
+                handler.callback = _guarded(handler.callback, key)
+    return states
+
+
 def init_user_state(context):
     """
     # 1.2.1: Сбрасываем FSM и заготовку под новую операцию